@@ -0,0 +1,238 @@
+import os
+import sys
+import math
+import time
+import json
+import asyncio
+import argparse
+import functools
+import platform
+import tempfile
+import subprocess
+from typing import Any, Callable, Optional, cast
+
+import cv2
+import numpy
+import numpy.typing
+import torch
+
+from buganime import buganime, settings, transcode
+
+
+def _measure_fps(func: Callable[[], object], frames: int) -> float:
+    func()
+    start = time.perf_counter()
+    for _ in range(frames):
+        func()
+    return frames / (time.perf_counter() - start)
+
+
+def _to_cpu_bytes(tensor: torch.Tensor) -> torch.Tensor:
+    return (tensor.clamp(0, 1) * 255.0).round().byte().squeeze(0).permute(1, 2, 0).cpu()
+
+
+def bench_resize(width: int, height: int, width_out: int, height_out: int, frames: int) -> dict[str, float]:
+    device, dtype = (torch.device('cuda'), torch.half) if torch.cuda.is_available() else (torch.device('cpu'), torch.float)
+    upscaled = torch.rand((1, 3, height * transcode.MODEL_SCALE, width * transcode.MODEL_SCALE), device=device, dtype=dtype)
+    results = {
+        'cv2': _measure_fps(lambda: cv2.resize(_to_cpu_bytes(upscaled).numpy(), (width_out, height_out), interpolation=cv2.INTER_LANCZOS4), frames),
+        'torch': _measure_fps(lambda: _to_cpu_bytes(torch.nn.functional.interpolate(upscaled, size=(height_out, width_out), mode='bicubic', antialias=True)),
+                              frames),
+    }
+
+    args = ('-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width * transcode.MODEL_SCALE}x{height * transcode.MODEL_SCALE}', '-i', 'pipe:',
+            '-vf', f'scale={width_out}:{height_out}:flags=lanczos', '-f', 'null', '-', '-loglevel', 'warning', '-hide_banner')
+    start = time.perf_counter()
+    with subprocess.Popen(['ffmpeg', *args], stdin=subprocess.PIPE) as proc:
+        assert proc.stdin
+        for _ in range(frames):
+            proc.stdin.write(_to_cpu_bytes(upscaled).numpy().tobytes())
+        proc.stdin.close()
+    results['ffmpeg'] = frames / (time.perf_counter() - start)
+    return results
+
+
+STAGES = ('decode', 'model', 'resize', 'encode', 'end_to_end', 'cpu_precision')
+# The test clips live next to the package in a source checkout
+DEFAULT_CLIP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data', '0.mkv')
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def ssim(image: numpy.typing.NDArray[numpy.uint8], reference: numpy.typing.NDArray[numpy.uint8]) -> float:
+    # Mean structural similarity of the RGB images' luma with the usual 11x11 gaussian window
+    image_float = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).astype(numpy.float32)
+    reference_float = cv2.cvtColor(reference, cv2.COLOR_RGB2GRAY).astype(numpy.float32)
+
+    def _blur(array: numpy.typing.NDArray[numpy.float32]) -> numpy.typing.NDArray[numpy.float32]:
+        return cast(numpy.typing.NDArray[numpy.float32], cv2.GaussianBlur(array, (11, 11), 1.5))
+
+    mean_image, mean_reference = _blur(image_float), _blur(reference_float)
+    variance_image = _blur(image_float ** 2) - mean_image ** 2
+    variance_reference = _blur(reference_float ** 2) - mean_reference ** 2
+    covariance = _blur(image_float * reference_float) - mean_image * mean_reference
+    ssim_map = ((2 * mean_image * mean_reference + SSIM_C1) * (2 * covariance + SSIM_C2) /
+                ((mean_image ** 2 + mean_reference ** 2 + SSIM_C1) * (variance_image + variance_reference + SSIM_C2)))
+    return float(ssim_map.mean())
+
+
+def read_clip(path: str, frames: int) -> torch.Tensor:
+    video = cv2.VideoCapture(path)
+    try:
+        images: list[numpy.typing.NDArray[Any]] = []
+        while len(images) < frames and (image := video.read()[1]) is not None:
+            images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    finally:
+        video.release()
+    if not images:
+        raise RuntimeError(f'No frames could be read from {path}')
+    return torch.from_numpy(numpy.stack(images))
+
+
+def bench_precision(clip: str, frames: int, tile_memory: Optional[int] = None) -> dict[str, dict[str, float]]:
+    # Upscales the first frames of `clip` on the CPU in every precision, and compares each against fp32. int8 is calibrated on the frames after them,
+    # so it isn't scored on the very frames it was quantized for.
+    inputs = read_clip(clip, 2 * frames)
+    inputs, calibration = inputs[:frames], inputs[frames:]
+    tile_size = _tile_size(tile_memory)
+    results = {}
+    reference = None
+    for precision in settings.CPU_PRECISIONS:
+        engine = transcode.UpscaleEngine(cuda=False, cpu_precision=precision)
+        engine.calibrate(calibration if len(calibration) else inputs, tile_size=tile_size)
+        outputs = [engine.upscale_batch(inputs[i:i + 1], tile_size=tile_size)[0].numpy() for i in range(len(inputs))]
+        start = time.perf_counter()
+        for i in range(len(inputs)):
+            engine.upscale_batch(inputs[i:i + 1], tile_size=tile_size)
+        results[precision] = {'fps': len(inputs) / (time.perf_counter() - start)}
+        if reference is None:
+            reference = outputs
+        results[precision]['psnr'] = min(cv2.PSNR(output, expected) for output, expected in zip(outputs, reference))
+        results[precision]['ssim'] = min(ssim(output, expected) for output, expected in zip(outputs, reference))
+    return results
+
+
+def _tile_size(tile_memory: Optional[int]) -> Optional[int]:
+    return None if tile_memory is None else max(transcode.MIN_TILE_SIZE, math.isqrt(tile_memory // transcode.ACTIVATION_BYTES_PER_PIXEL))
+
+
+def host_info() -> dict[str, Any]:
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+            'torch': torch.__version__, 'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None}
+
+
+def bench_decode(clip: str) -> dict[str, float]:
+    # Decodes the whole clip to raw RGB frames, as the transcoder's input side does
+    frame = read_clip(clip, frames=1)[0]
+    args = ('-i', clip, '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:', '-loglevel', 'warning', '-hide_banner')
+    decoded = 0
+    start = time.perf_counter()
+    with subprocess.Popen(['ffmpeg', *args], stdout=subprocess.PIPE) as proc:
+        assert proc.stdout
+        while chunk := proc.stdout.read(1024 ** 2):
+            decoded += len(chunk)
+    return {'fps': decoded / frame.numel() / (time.perf_counter() - start)}
+
+
+def bench_model(width: int, height: int, batch_sizes: list[int], tile_sizes: list[Optional[int]], frames: int,
+                engine: Optional[transcode.UpscaleEngine] = None) -> list[dict[str, Any]]:
+    # Times the model alone on random frames for every combination of batch and tile size
+    engine = engine or transcode.UpscaleEngine()
+    results = []
+    for batch_size in batch_sizes:
+        batch = torch.randint(0, 256, (batch_size, height, width, 3), dtype=torch.uint8)
+        for tile_size in tile_sizes:
+            batches = math.ceil(frames / batch_size)
+            fps = _measure_fps(functools.partial(engine.upscale_batch, batch, tile_size=tile_size), batches) * batch_size
+            results.append({'batch_size': batch_size, 'tile_size': tile_size, 'fps': fps})
+    return results
+
+
+def bench_encode(clip: str, width_out: int, height_out: int, frames: int, profiles: list[str],
+                 encoder_threads: Optional[int] = None) -> dict[str, dict[str, Any]]:
+    # Encodes the clip's frames, resized to the output resolution, with each of the transcoder's encode profiles. A profile whose encoder this
+    # ffmpeg build lacks is reported as failed rather than ending the benchmark.
+    images = [cv2.resize(image, (width_out, height_out), interpolation=cv2.INTER_LANCZOS4).tobytes() for image in read_clip(clip, frames).numpy()]
+    results: dict[str, dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for profile in profiles:
+            output_path = os.path.join(temp_dir, f'{profile}.mkv')
+            args = ('-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width_out}x{height_out}', '-r', '24', '-i', 'pipe:',
+                    *settings.ENCODE_PROFILES[profile].args(threads=encoder_threads), output_path, '-loglevel', 'warning', '-hide_banner', '-y')
+            start = time.perf_counter()
+            with subprocess.Popen(['ffmpeg', *args], stdin=subprocess.PIPE) as proc:
+                assert proc.stdin
+                try:
+                    for i in range(frames):
+                        proc.stdin.write(images[i % len(images)])
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            if proc.returncode:
+                results[profile] = {'error': f'ffmpeg exited with {proc.returncode}'}
+                continue
+            results[profile] = {'fps': frames / (time.perf_counter() - start), 'bytes_per_frame': os.path.getsize(output_path) / frames}
+    return results
+
+
+def bench_end_to_end(clip: str, width_out: int, height_out: int, frames: int, options: Optional[settings.TranscodeOptions] = None) -> dict[str, float]:
+    # Runs the whole pipeline over the first frames of the clip. Loading the model is not included.
+    proc = subprocess.run(['ffprobe', '-show_format', '-show_streams', '-of', 'json', clip], text=True, capture_output=True, check=True,
+                          encoding='utf-8')
+    video_info = buganime.parse_streams(json.loads(proc.stdout)['streams'], accept_no_subtitles=True)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'output.mkv')
+        transcoder = transcode.Transcoder(input_path=clip, output_path=output_path, height_out=height_out, width_out=width_out, video_info=video_info,
+                                          options=options)
+        start = time.perf_counter()
+        written = asyncio.run(transcoder.run_range(output_path, start=0, count=frames))
+        return {'fps': written / (time.perf_counter() - start)}
+
+
+def main(args: list[str]) -> int:
+    argparser = argparse.ArgumentParser(description='Benchmark the stages of the transcode pipeline on this host')
+    argparser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to benchmark (default: all)')
+    argparser.add_argument('--output', help='Also write the results as JSON to this file')
+    argparser.add_argument('--width', type=int, default=1920, help='Width of the input frames')
+    argparser.add_argument('--height', type=int, default=1080, help='Height of the input frames')
+    argparser.add_argument('--width-out', type=int, default=3840, help='Width of the output frames')
+    argparser.add_argument('--height-out', type=int, default=2160, help='Height of the output frames')
+    argparser.add_argument('--frames', type=int, default=10, help='Number of frames to time each stage over')
+    argparser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4], help='Batch sizes to time the model with')
+    argparser.add_argument('--tile-sizes', type=int, nargs='+', default=[0, 512], help='Tile sizes to time the model with, 0 for whole frames')
+    argparser.add_argument('--clip', default=DEFAULT_CLIP, help='Video to time decoding, encoding and the whole pipeline on')
+    argparser.add_argument('--clip-frames', type=int, default=2,
+                           help='Number of frames of the clip to run the whole pipeline and compare the CPU precisions on')
+    argparser.add_argument('--tile-memory', type=int, default=1024, help='MiB of model activations to upscale the clip in tiles of')
+    argparser.add_argument('--encode-profiles', nargs='+', choices=settings.ENCODE_PROFILES, default=list(settings.ENCODE_PROFILES),
+                           help='Encode profiles to time (default: all)')
+    argparser.add_argument('--encoder-threads', type=int, help='Threads to encode with (default: the encoder decides)')
+    parsed = argparser.parse_args(args)
+
+    # Each stage is written out as soon as it finishes, so a long run that gets interrupted still leaves results behind
+    results: dict[str, Any] = {'host': host_info()}
+    stages: dict[str, Callable[[], Any]] = {
+        'decode': lambda: bench_decode(parsed.clip),
+        'model': lambda: bench_model(width=parsed.width, height=parsed.height, batch_sizes=parsed.batch_sizes,
+                                     tile_sizes=[tile_size or None for tile_size in parsed.tile_sizes], frames=parsed.frames),
+        'resize': lambda: bench_resize(width=parsed.width, height=parsed.height, width_out=parsed.width_out, height_out=parsed.height_out,
+                                       frames=parsed.frames),
+        'encode': lambda: bench_encode(parsed.clip, width_out=parsed.width_out, height_out=parsed.height_out, frames=parsed.frames,
+                                       profiles=parsed.encode_profiles, encoder_threads=parsed.encoder_threads),
+        'end_to_end': lambda: bench_end_to_end(parsed.clip, width_out=parsed.width_out, height_out=parsed.height_out, frames=parsed.clip_frames,
+                                               options=settings.TranscodeOptions(tile_memory=parsed.tile_memory * 1024 ** 2)),
+        'cpu_precision': lambda: bench_precision(clip=parsed.clip, frames=parsed.clip_frames, tile_memory=parsed.tile_memory * 1024 ** 2),
+    }
+    for stage in STAGES:
+        if stage not in parsed.stages:
+            continue
+        results[stage] = stages[stage]()
+        if parsed.output:
+            with open(parsed.output, 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=4)
+    print(json.dumps(results, indent=4))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,7 +2,6 @@ import os
 import sys
 import tempfile
 import datetime
-import contextlib
 import logging
 import re
 import dataclasses
@@ -10,27 +9,21 @@ import json
 import subprocess
 import asyncio
 import argparse
-from typing import Iterator, Any
+import collections
+import contextlib
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional
 
-import win32event
+from buganime import jobs, library, settings, watch
 
-from buganime import transcode
+# buganime.transcode and buganime.segments import torch, which takes seconds, so they are only imported once a file is actually transcoded
+if TYPE_CHECKING:
+    from buganime import transcode
 
 
 OUTPUT_DIR = os.getenv('BUGANIME_OUTPUT_DIR', '')
-UPSCALE_MUTEX_NAME = 'anime4kconvert'
 
 SUPPORTED_SUBTITLE_CODECS = ('ass', 'subrip')
-
-
-@contextlib.contextmanager
-def lock_mutex(name: str) -> Iterator[None]:
-    mutex = win32event.CreateMutex(None, 1, name)
-    try:
-        win32event.WaitForSingleObject(mutex, -1)
-        yield
-    finally:
-        mutex.close()
+PROBE_PREFETCH = 4
 
 
 @dataclasses.dataclass
@@ -45,7 +38,7 @@ class Movie:
     name: str
 
 
-def parse_streams(streams: Any, accept_no_subtitles: bool = False) -> transcode.VideoInfo:
+def parse_streams(streams: Any, accept_no_subtitles: bool = False) -> settings.VideoInfo:
     def _get_video_stream() -> Any:
         video_streams = [stream for stream in streams if stream['codec_type'] == 'video']
         if len(video_streams) == 1:
@@ -91,9 +84,9 @@ def parse_streams(streams: Any, accept_no_subtitles: bool = False) -> transcode.
     except RuntimeError:
         if not accept_no_subtitles:
             raise
-    return transcode.VideoInfo(audio_index=_get_audio_stream()['index'], subtitle_index=subtitle_index,
-                               width=video['width'], height=video['height'], fps=video['r_frame_rate'],
-                               frames=int(video.get('tags', {}).get('NUMBER_OF_FRAMES') or video.get('tags', {}).get('NUMBER_OF_FRAMES-eng') or 0))
+    return settings.VideoInfo(audio_index=_get_audio_stream()['index'], subtitle_index=subtitle_index,
+                              width=video['width'], height=video['height'], fps=video['r_frame_rate'],
+                              frames=int(video.get('tags', {}).get('NUMBER_OF_FRAMES') or video.get('tags', {}).get('NUMBER_OF_FRAMES-eng') or 0))
 
 
 def parse_filename(input_path: str) -> TVShow | Movie:
@@ -131,61 +124,235 @@ def parse_filename(input_path: str) -> TVShow | Movie:
     return Movie(name=input_name)
 
 
-def process_file(input_path: str, accept_no_subtitles: bool = False) -> None:
-    if not input_path.endswith('.mkv'):
-        return
+@dataclasses.dataclass
+class PreparedFile:
+    input_path: str
+    output_path: str
+    video_info: settings.VideoInfo
+    converted: bool = False
 
-    logging.info('Converting %s', input_path)
 
+async def _probe_streams(input_path: str) -> Any:
+    args = ['ffprobe', '-show_format', '-show_streams', '-of', 'json', input_path]
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    logging.info('ffprobe %s wrote %s, %s', str(args), stderr.decode('utf-8', errors='replace'), stdout.decode('utf-8', errors='replace'))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+    return json.loads(stdout)['streams']
+
+
+async def prepare_file(input_path: str, accept_no_subtitles: bool = False, index: Optional[library.LibraryIndex] = None) -> PreparedFile:
     # Put in the correct path
     parsed = parse_filename(input_path=input_path)
     if isinstance(parsed, TVShow):
         output_path = os.path.join(OUTPUT_DIR, 'TV Shows', parsed.name, f'{parsed.name} S{parsed.season:02d}E{parsed.episode:02d}.mkv')
     else:
         output_path = os.path.join(OUTPUT_DIR, 'Movies', f'{parsed.name}.mkv')
-    if not os.path.isdir(os.path.dirname(output_path)):
-        os.makedirs(os.path.dirname(output_path))
+    logging.info('Output of %s is %s', input_path, output_path)
 
-    logging.info('Output is %s', output_path)
+    # Unchanged files that were seen before are planned from the index without running ffprobe again
+    entry = await asyncio.to_thread(index.lookup, input_path) if index is not None else None
+    if entry is not None:
+        logging.info('Using the indexed streams of %s', input_path)
+        streams = entry.streams
+    else:
+        streams = await _probe_streams(input_path)
+        if index is not None:
+            await asyncio.to_thread(index.record, input_path, streams, parsed, output_path)
+    video_info = parse_streams(streams, accept_no_subtitles=accept_no_subtitles)
+    converted = entry is not None and entry.status == 'done' and entry.output_path == output_path and os.path.isfile(output_path)
+    return PreparedFile(input_path=input_path, output_path=output_path, video_info=video_info, converted=converted)
+
+
+async def prepare_files(input_path: str, accept_no_subtitles: bool = False, prefetch: int = PROBE_PREFETCH,
+                        index: Optional[library.LibraryIndex] = None, skip_converted: bool = True) -> AsyncIterator[tuple[str, Optional[PreparedFile]]]:
+    # Walks the input and probes up to `prefetch` files ahead of the consumer, so probing a slow share overlaps whatever the consumer does with the
+    # previous files. Files that can't be converted are reported as soon as their probe finishes and are yielded in order with None. Files the index
+    # says were already converted are skipped, unless `skip_converted` is False.
+    async def _input_paths() -> AsyncIterator[str]:
+        if not os.path.isdir(input_path):
+            yield input_path
+            return
+        walk = os.walk(input_path)
+        while (entry := await asyncio.to_thread(next, walk, None)) is not None:
+            root, _, files = entry
+            for file in files:
+                yield os.path.join(root, file)
+
+    async def _prepare(path: str) -> Optional[PreparedFile]:
+        try:
+            prepared = await prepare_file(input_path=path, accept_no_subtitles=accept_no_subtitles, index=index)
+        except Exception:
+            logging.exception('Failed to probe %s', path)
+            return None
+        if prepared.converted and skip_converted:
+            logging.info('Skipping %s, already converted to %s', path, prepared.output_path)
+        return prepared
+
+    pending: collections.deque[tuple[str, asyncio.Task[Optional[PreparedFile]]]] = collections.deque()
+    try:
+        async for path in _input_paths():
+            if not path.endswith('.mkv'):
+                continue
+            pending.append((path, asyncio.create_task(_prepare(path))))
+            if len(pending) > prefetch:
+                path, task = pending.popleft()
+                if (prepared := await task) is None or not prepared.converted or not skip_converted:
+                    yield path, prepared
+        while pending:
+            path, task = pending.popleft()
+            if (prepared := await task) is None or not prepared.converted or not skip_converted:
+                yield path, prepared
+    finally:
+        for _, task in pending:
+            task.cancel()
 
-    proc = subprocess.run(['ffprobe', '-show_format', '-show_streams', '-of', 'json', input_path], text=True, capture_output=True, check=True,
-                          encoding='utf-8')
-    logging.info('ffprobe %s wrote %s, %s', str(proc.args), proc.stderr, proc.stdout)
-    video_info = parse_streams(json.loads(proc.stdout)['streams'], accept_no_subtitles=accept_no_subtitles)
 
+async def transcode_file(prepared: PreparedFile, options: Optional[settings.TranscodeOptions] = None, index: Optional[library.LibraryIndex] = None,
+                         engine: Optional['transcode.UpscaleEngine'] = None, pool: Optional['transcode.WorkerPool'] = None) -> None:
+    from buganime import segments, transcode  # pylint: disable=import-outside-toplevel,redefined-outer-name
+    os.makedirs(os.path.dirname(prepared.output_path), exist_ok=True)
     try:
-        with lock_mutex(name=UPSCALE_MUTEX_NAME):
-            logging.info('Running Upscaler')
-            asyncio.run(transcode.Transcoder(input_path=input_path, output_path=output_path, height_out=2160, width_out=3840, video_info=video_info).run())
-            logging.info('Upscaler for %s finished', input_path)
+        logging.info('Running Upscaler')
+        if options is not None and options.segment_length is not None:
+            await segments.transcode_segmented(input_path=prepared.input_path, output_path=prepared.output_path, height_out=2160, width_out=3840,
+                                               video_info=prepared.video_info, options=options, engine=engine, pool=pool)
+        else:
+            await transcode.Transcoder(input_path=prepared.input_path, output_path=prepared.output_path, height_out=2160, width_out=3840,
+                                       video_info=prepared.video_info, options=options, engine=engine, pool=pool).run()
+        logging.info('Upscaler for %s finished', prepared.input_path)
     except Exception:
-        logging.warning('Upscaler for %s failed. Deleting output %s', input_path, output_path)
+        logging.warning('Upscaler for %s failed. Deleting output %s', prepared.input_path, prepared.output_path)
         try:
-            os.unlink(output_path)
+            os.unlink(prepared.output_path)
         except Exception:
             pass
+        if index is not None:
+            await asyncio.to_thread(index.finish, prepared.input_path, prepared.video_info, False)
         raise
+    if index is not None:
+        await asyncio.to_thread(index.finish, prepared.input_path, prepared.video_info, True)
 
 
-def process_path(input_path: str, accept_no_subtitles: bool = False) -> None:
-    if os.path.isdir(input_path):
-        for root, _, files in os.walk(input_path):
-            for file in files:
-                try:
-                    process_file(input_path=os.path.join(root, file), accept_no_subtitles=accept_no_subtitles)
-                except Exception:
-                    logging.exception('Failed to convert %s', input_path)
-    else:
-        process_file(input_path=input_path, accept_no_subtitles=accept_no_subtitles)
+def process_file(input_path: str, accept_no_subtitles: bool = False, options: Optional[settings.TranscodeOptions] = None,
+                 index: Optional[library.LibraryIndex] = None) -> None:
+    if not input_path.endswith('.mkv'):
+        return
 
+    logging.info('Converting %s', input_path)
+    prepared = asyncio.run(prepare_file(input_path=input_path, accept_no_subtitles=accept_no_subtitles, index=index))
+    if prepared.converted:
+        logging.info('Skipping %s, already converted to %s', input_path, prepared.output_path)
+        return
+    asyncio.run(transcode_file(prepared, options=options, index=index))
 
-def main(args: list[str]) -> int:
-    argparser = argparse.ArgumentParser(description='Convert anime files to 4K')
-    argparser.add_argument('input_path', type=str, help='Path to the input file or directory')
-    argparser.add_argument('--accept-no-subtitles', action='store_true', help='Accept files with no subtitles')
-    parsed = argparser.parse_args(args)
 
-    input_path = parsed.input_path
+async def _process_files(input_path: str, accept_no_subtitles: bool, options: Optional[settings.TranscodeOptions], prefetch: int,
+                         index: Optional[library.LibraryIndex]) -> None:
+    async for path, prepared in prepare_files(input_path=input_path, accept_no_subtitles=accept_no_subtitles, prefetch=prefetch, index=index):
+        if prepared is None:
+            continue
+        logging.info('Converting %s', path)
+        try:
+            await transcode_file(prepared, options=options, index=index)
+        except Exception:
+            logging.exception('Failed to convert %s', path)
+
+
+def process_path(input_path: str, accept_no_subtitles: bool = False, options: Optional[settings.TranscodeOptions] = None,
+                 prefetch: int = PROBE_PREFETCH, index: Optional[library.LibraryIndex] = None) -> None:
+    if os.path.isdir(input_path):
+        asyncio.run(_process_files(input_path=input_path, accept_no_subtitles=accept_no_subtitles, options=options, prefetch=prefetch, index=index))
+    else:
+        process_file(input_path=input_path, accept_no_subtitles=accept_no_subtitles, options=options, index=index)
+
+
+async def _enqueue_files(queue: jobs.JobQueue, input_path: str, accept_no_subtitles: bool, options: Optional[settings.TranscodeOptions], priority: int,
+                         prefetch: int, index: Optional[library.LibraryIndex]) -> tuple[dict[int, str], int]:
+    queued: dict[int, str] = {}
+    rejected = 0
+    async for path, prepared in prepare_files(input_path=input_path, accept_no_subtitles=accept_no_subtitles, prefetch=prefetch, index=index):
+        if prepared is None:
+            rejected += 1
+            continue
+        logging.info('Queueing %s', path)
+        job_id = queue.enqueue(input_path=path, accept_no_subtitles=accept_no_subtitles, options=options, priority=priority,
+                               output_path=prepared.output_path, video_info=prepared.video_info)
+        queued[job_id] = path
+    return queued, rejected
+
+
+def run_job(job: jobs.Job, index: Optional[library.LibraryIndex] = None) -> None:
+    # Jobs are converted with what was found when queueing them, so only files that changed since are probed again
+    if job.output_path is None or job.video_info is None:
+        process_file(input_path=job.input_path, accept_no_subtitles=job.accept_no_subtitles, options=job.options, index=index)
+        return
+    logging.info('Converting %s', job.input_path)
+    asyncio.run(transcode_file(PreparedFile(input_path=job.input_path, output_path=job.output_path, video_info=job.video_info), options=job.options,
+                               index=index))
+
+
+def enqueue_path(queue: jobs.JobQueue, input_path: str, accept_no_subtitles: bool = False, options: Optional[settings.TranscodeOptions] = None,
+                 priority: int = 0, prefetch: int = PROBE_PREFETCH, index: Optional[library.LibraryIndex] = None) -> tuple[dict[int, str], int]:
+    # Only files that probe and parse cleanly are queued, so broken files are reported before any upscaling starts. Returns the queued files
+    # by job id, and the number of those that weren't.
+    return asyncio.run(_enqueue_files(queue, input_path=input_path, accept_no_subtitles=accept_no_subtitles, options=options, priority=priority,
+                                      prefetch=prefetch, index=index))
+
+
+async def _plan_files(input_path: str, accept_no_subtitles: bool, prefetch: int, index: Optional[library.LibraryIndex]) -> int:
+    rejected = 0
+    async for path, prepared in prepare_files(input_path=input_path, accept_no_subtitles=accept_no_subtitles, prefetch=prefetch, index=index,
+                                              skip_converted=False):
+        if prepared is None:
+            print(f'{path}: can not be converted')
+            rejected += 1
+            continue
+        info = prepared.video_info
+        subtitles = 'no subtitles' if info.subtitle_index is None else f'subtitle stream {info.subtitle_index}'
+        converted = ' (already converted)' if prepared.converted else ''
+        print(f'{path} -> {prepared.output_path}{converted}: {info.width}x{info.height} at {info.fps} fps, {info.frames} frames, '
+              f'audio stream {info.audio_index}, {subtitles}')
+    return rejected
+
+
+def plan_path(input_path: str, accept_no_subtitles: bool = False, prefetch: int = PROBE_PREFETCH, index: Optional[library.LibraryIndex] = None) -> int:
+    # Prints where every file under `input_path` would be converted to and which of its streams would be used, without converting or queueing
+    # anything. Returns the number of files that can't be converted.
+    return asyncio.run(_plan_files(input_path, accept_no_subtitles=accept_no_subtitles, prefetch=prefetch, index=index))
+
+
+async def _watch_paths(input_paths: list[str], accept_no_subtitles: bool, options: Optional[settings.TranscodeOptions],
+                       index: Optional[library.LibraryIndex], settle_time: float) -> None:
+    # The model stays loaded for the lifetime of the daemon instead of being reloaded for every file, in-process or in its worker processes
+    from buganime import transcode  # pylint: disable=import-outside-toplevel,redefined-outer-name
+    options = options or settings.TranscodeOptions()
+    if options.segment_length is not None and options.segment_workers > 1:
+        logging.warning('Segment worker processes load the model for every segment, only --segment-workers 1 keeps it loaded')
+    engine = await asyncio.to_thread(transcode.UpscaleEngine, compile_mode=options.compile_mode, channels_last=options.channels_last,
+                                     cpu_precision=options.cpu_precision, model=options.model)
+    with contextlib.ExitStack() as stack:
+        pool = stack.enter_context(transcode.WorkerPool(options)) if options.workers > 1 and engine.device.type == 'cpu' else None
+        async for path in watch.watch_files(input_paths, settle_time=settle_time):
+            try:
+                prepared = await prepare_file(input_path=path, accept_no_subtitles=accept_no_subtitles, index=index)
+                if prepared.converted:
+                    logging.info('Skipping %s, already converted to %s', path, prepared.output_path)
+                    continue
+                logging.info('Converting %s', path)
+                await transcode_file(prepared, options=options, index=index, engine=engine, pool=pool)
+            except Exception:
+                logging.exception('Failed to convert %s', path)
+
+
+def watch_paths(input_paths: list[str], accept_no_subtitles: bool = False, options: Optional[settings.TranscodeOptions] = None,
+                index: Optional[library.LibraryIndex] = None, settle_time: float = watch.SETTLE_TIME) -> None:
+    # Converts new files under `input_paths` as they finish downloading, until interrupted
+    asyncio.run(_watch_paths(input_paths, accept_no_subtitles=accept_no_subtitles, options=options, index=index, settle_time=settle_time))
+
+
+def _setup_logging(input_path: str) -> str:
     log_prefix = f'buganime_{os.path.basename(input_path)}_{datetime.datetime.now().strftime("%Y_%m_%d-%H_%M_%S")}'
     with tempfile.NamedTemporaryFile(mode='w', prefix=log_prefix, suffix='.txt', delete=False) as log_file:
         pass
@@ -200,11 +367,105 @@ def main(args: list[str]) -> int:
     handler_file.setLevel(logging.DEBUG)
     handler_file.setFormatter(formatter)
     root.addHandler(handler_file)
+    return log_file.name
+
+
+def _parse_args(args: list[str]) -> argparse.Namespace:
+    argparser = argparse.ArgumentParser(description='Convert anime files to 4K')
+    argparser.add_argument('input_path', type=str, help='Path to the input file or directory')
+    argparser.add_argument('--accept-no-subtitles', action='store_true', help='Accept files with no subtitles')
+    argparser.add_argument('--watch', action='store_true',
+                           help='Keep running and convert new files under input_path once they finish downloading, holding one slot and the model throughout')
+    argparser.add_argument('--settle-time', type=float, default=watch.SETTLE_TIME,
+                           help='Seconds a watched file must stay unchanged before it is converted')
+    argparser.add_argument('--priority', type=int, default=0, help='Queue priority of the input files, higher runs first')
+    argparser.add_argument('--prefetch', type=int, default=PROBE_PREFETCH, help='Number of files to probe concurrently while scanning a directory')
+    argparser.add_argument('--no-index', action='store_true',
+                           help='Probe and convert every file, instead of skipping the ones the index in the output directory says are unchanged and converted')
+    argparser.add_argument('--slots', type=int, default=1, help='Number of transcodes allowed to run at once across all buganime instances')
+    argparser.add_argument('--batch-size', type=int, help='Number of frames to upscale per model call (default: automatic)')
+    argparser.add_argument('--dedup-threshold', type=float, default=settings.DEDUP_THRESHOLD,
+                           help='Reuse the previous upscaled frame when no 16x16 block differs from it by more than this mean absolute difference. '
+                                'Around 4 skips the held drawings of lossy sources, but turns slow fades into steps (default: identical frames only)')
+    argparser.add_argument('--workers', type=int, default=1, help='Number of worker processes running the model on CPU-only hosts')
+    argparser.add_argument('--worker-threads', type=int, help='Torch threads per worker process (default: CPU cores divided between the workers)')
+    argparser.add_argument('--resize-backend', choices=settings.RESIZE_BACKENDS, default='cv2',
+                           help='Where to resize the model output to the output resolution (see python -m buganime.bench)')
+    argparser.add_argument('--segment-length', type=float,
+                           help='Encode in resumable keyframe-aligned segments of at least this many seconds (default: single pass)')
+    argparser.add_argument('--segment-workers', type=int, default=1, help='Number of local worker processes encoding segments in parallel')
+    argparser.add_argument('--compile', choices=settings.COMPILE_MODES, help='Compile the model before upscaling (default: run it eagerly)')
+    argparser.add_argument('--cpu-precision', choices=settings.CPU_PRECISIONS, default='fp32',
+                           help='Precision of the model without CUDA, trading quality for speed (see python -m buganime.bench)')
+    argparser.add_argument('--model', default=settings.DEFAULT_MODEL,
+                           help=f'Model to upscale with: one of {", ".join(settings.MODELS)}, a weights file, or a JSON file describing a settings.ModelSpec')
+    argparser.add_argument('--channels-last', action='store_true', help='Run the model on channels-last tensors')
+    argparser.add_argument('--prometheus-file', help='Write pipeline metrics in the Prometheus text format to this file while transcoding')
+    argparser.add_argument('--tile-memory', type=int, help='Upscale in tiles that fit this many MiB of model activations (default: whole frames)')
+    argparser.add_argument('--encode-profile', choices=settings.ENCODE_PROFILES, default='x265',
+                           help='Encoder and its settings for the output (see python -m buganime.bench --stages encode)')
+    argparser.add_argument('--encode-preset', help="Override the encode profile's preset")
+    argparser.add_argument('--encode-crf', type=int, help="Override the encode profile's CRF")
+    argparser.add_argument('--encoder-threads', type=int,
+                           help='Encode with this many threads, leaving the rest of the cores to the model, and pin both to their cores on Linux '
+                                '(default: share all cores)')
+    argparser.add_argument('--crop-borders', action='store_true', help='Only upscale the picture inside black borders found on frames sampled from the video')
+    argparser.add_argument('--pipeline-memory', type=int, default=settings.PIPELINE_MEMORY // 1024 ** 2,
+                           help='MiB of decoded and upscaled frames the pipeline may hold in flight as it deepens to absorb stalls')
+    argparser.add_argument('--dry-run', action='store_true',
+                           help='Only print the output path and selected streams of every file under input_path, without converting or queueing anything')
+    return argparser.parse_args(args)
+
+
+def main(args: list[str]) -> int:
+    parsed = _parse_args(args)
+    input_path = parsed.input_path
+    if parsed.dry_run:
+        # Probes are still cached in an existing index, but neither the index nor a log file is created
+        index_path = os.path.join(OUTPUT_DIR, library.INDEX_NAME)
+        index = library.LibraryIndex(index_path) if not parsed.no_index and os.path.isfile(index_path) else None
+        try:
+            return 1 if plan_path(input_path, accept_no_subtitles=parsed.accept_no_subtitles, prefetch=parsed.prefetch, index=index) else 0
+        finally:
+            if index is not None:
+                index.close()
+    log_path = _setup_logging(input_path)
 
     logging.info('Buganime started running on %s', input_path)
     try:
-        process_path(input_path=input_path, accept_no_subtitles=parsed.accept_no_subtitles)
-        return 0
+        options = settings.TranscodeOptions(batch_size=parsed.batch_size, tile_memory=parsed.tile_memory * 1024 ** 2 if parsed.tile_memory else None,
+                                            dedup_threshold=parsed.dedup_threshold, workers=parsed.workers, worker_threads=parsed.worker_threads,
+                                            resize_backend=parsed.resize_backend, segment_length=parsed.segment_length,
+                                            segment_workers=parsed.segment_workers, compile_mode=parsed.compile, channels_last=parsed.channels_last,
+                                            cpu_precision=parsed.cpu_precision, metrics_dir=os.path.dirname(log_path),
+                                            prometheus_path=parsed.prometheus_file, pipeline_memory=parsed.pipeline_memory * 1024 ** 2,
+                                            encode_profile=parsed.encode_profile, encode_preset=parsed.encode_preset, encode_crf=parsed.encode_crf,
+                                            encoder_threads=parsed.encoder_threads, crop_borders=parsed.crop_borders,
+                                            model=os.path.abspath(parsed.model) if os.path.exists(parsed.model) else parsed.model)
+        index = None if parsed.no_index else library.LibraryIndex(os.path.join(OUTPUT_DIR, library.INDEX_NAME))
+        if parsed.watch:
+            try:
+                with jobs.lock_slot(jobs.QUEUE_DIR, parsed.slots):
+                    watch_paths([input_path], accept_no_subtitles=parsed.accept_no_subtitles, options=options, index=index, settle_time=parsed.settle_time)
+            finally:
+                if index is not None:
+                    index.close()
+            return 0
+        queue = jobs.JobQueue(os.path.join(jobs.QUEUE_DIR, 'queue.sqlite3'))
+        try:
+            queued, rejected = enqueue_path(queue, input_path=input_path, accept_no_subtitles=parsed.accept_no_subtitles, options=options,
+                                            priority=parsed.priority, prefetch=parsed.prefetch, index=index)
+            jobs.drain(queue, jobs.QUEUE_DIR, parsed.slots, lambda job: run_job(job, index=index), wait_for=queued)
+            # Another instance may have run some of the files queued here, so they are checked whoever ran them
+            statuses = queue.statuses(queued)
+            failed = [path for job_id, path in queued.items() if statuses[job_id][0] != 'done']
+            for path in failed:
+                logging.error('Failed to convert %s', path)
+        finally:
+            queue.close()
+            if index is not None:
+                index.close()
+        return 1 if failed or rejected else 0
     except Exception:
         logging.exception('Failed to convert %s', input_path)
         return 1
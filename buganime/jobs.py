@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import json
+import sqlite3
+import logging
+import tempfile
+import contextlib
+import dataclasses
+from typing import IO, Callable, Collection, Iterator, Optional
+
+from buganime import settings
+
+if sys.platform == 'win32':
+    import msvcrt  # pylint: disable=import-error
+else:
+    import fcntl  # pylint: disable=import-error
+
+
+QUEUE_DIR = os.getenv('BUGANIME_QUEUE_DIR', os.path.join(tempfile.gettempdir(), 'buganime'))
+SLOT_POLL_INTERVAL = 5
+
+
+@dataclasses.dataclass
+class Job:
+    id: int
+    input_path: str
+    accept_no_subtitles: bool
+    options: settings.TranscodeOptions
+    priority: int
+    # Where the input is converted to and its streams, as found when it was queued. None if it wasn't probed or changed since.
+    output_path: Optional[str] = None
+    video_info: Optional[settings.VideoInfo] = None
+
+
+def _try_lock(file: IO[bytes]) -> bool:
+    file.seek(0)
+    try:
+        if sys.platform == 'win32':
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(file: IO[bytes]) -> None:
+    file.seek(0)
+    if sys.platform == 'win32':
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def _slot_path(lock_dir: str, slot: int) -> str:
+    return os.path.join(lock_dir, f'slot{slot}.lock')
+
+
+@contextlib.contextmanager
+def lock_slot(lock_dir: str, slots: int) -> Iterator[int]:
+    # Blocks until one of `slots` lock files can be locked exclusively, and yields its index. The lock is released by the OS if the process dies.
+    os.makedirs(lock_dir, exist_ok=True)
+    while True:
+        for slot in range(slots):
+            with open(_slot_path(lock_dir, slot), 'a+b') as file:
+                if not _try_lock(file):
+                    continue
+                try:
+                    yield slot
+                finally:
+                    _unlock(file)
+                return
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+class JobQueue:
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, input_path TEXT NOT NULL, '
+                                  'accept_no_subtitles INTEGER NOT NULL, options TEXT NOT NULL, priority INTEGER NOT NULL, status TEXT NOT NULL, '
+                                  'slot INTEGER, enqueued_at REAL NOT NULL, finished_at REAL, prepared TEXT)')
+        # Queues created before jobs carried what was found when queueing them. Another instance may be adding the column at the same time.
+        if 'prepared' not in {row[1] for row in self.__connection.execute('PRAGMA table_info(jobs)')}:
+            with contextlib.suppress(sqlite3.OperationalError):
+                self.__connection.execute('ALTER TABLE jobs ADD COLUMN prepared TEXT')
+
+    def close(self) -> None:
+        self.__connection.close()
+
+    def enqueue(self, input_path: str, accept_no_subtitles: bool = False, options: Optional[settings.TranscodeOptions] = None, priority: int = 0,
+                output_path: Optional[str] = None, video_info: Optional[settings.VideoInfo] = None) -> int:
+        # A file that is already waiting is not queued twice, but its priority and options are updated. `output_path` and `video_info` spare
+        # probing the file again when the job runs, as long as it doesn't change in the meantime.
+        input_path = os.path.abspath(input_path)
+        options_json = json.dumps(dataclasses.asdict(options or settings.TranscodeOptions()))
+        prepared_json = None
+        if output_path is not None and video_info is not None:
+            stat = os.stat(input_path)
+            prepared_json = json.dumps({'output_path': os.path.abspath(output_path), 'video_info': dataclasses.asdict(video_info), 'size': stat.st_size,
+                                        'mtime_ns': stat.st_mtime_ns})
+        self.__connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.__connection.execute("SELECT id FROM jobs WHERE input_path = ? AND status = 'queued'", (input_path,)).fetchone()
+            if row is not None:
+                self.__connection.execute('UPDATE jobs SET accept_no_subtitles = ?, options = ?, priority = ?, prepared = ? WHERE id = ?',
+                                          (accept_no_subtitles, options_json, priority, prepared_json, row[0]))
+                job_id = int(row[0])
+            else:
+                cursor = self.__connection.execute('INSERT INTO jobs (input_path, accept_no_subtitles, options, priority, status, enqueued_at, prepared) '
+                                                   "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                                                   (input_path, accept_no_subtitles, options_json, priority, time.time(), prepared_json))
+                job_id = int(cursor.lastrowid or 0)
+            self.__connection.execute('COMMIT')
+        except BaseException:
+            self.__connection.execute('ROLLBACK')
+            raise
+        return job_id
+
+    def claim(self, slot: int) -> Optional[Job]:
+        self.__connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Whoever ran a job in this slot before us no longer holds its lock, so it died midway
+            self.__connection.execute("UPDATE jobs SET status = 'queued', slot = NULL WHERE status = 'running' AND slot = ?", (slot,))
+            row = self.__connection.execute("SELECT id, input_path, accept_no_subtitles, options, priority, prepared FROM jobs WHERE status = 'queued' "
+                                            'ORDER BY priority DESC, id LIMIT 1').fetchone()
+            if row is not None:
+                self.__connection.execute("UPDATE jobs SET status = 'running', slot = ? WHERE id = ?", (slot, row[0]))
+            self.__connection.execute('COMMIT')
+        except BaseException:
+            self.__connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        job = Job(id=row[0], input_path=row[1], accept_no_subtitles=bool(row[2]), options=settings.TranscodeOptions(**json.loads(row[3])),
+                  priority=row[4])
+        if row[5] is not None:
+            prepared = json.loads(row[5])
+            with contextlib.suppress(OSError):
+                stat = os.stat(job.input_path)
+                if (stat.st_size, stat.st_mtime_ns) == (prepared['size'], prepared['mtime_ns']):
+                    job.output_path, job.video_info = prepared['output_path'], settings.VideoInfo(**prepared['video_info'])
+        return job
+
+    def finish(self, job: Job, succeeded: bool) -> None:
+        self.__connection.execute('UPDATE jobs SET status = ?, slot = NULL, finished_at = ? WHERE id = ?',
+                                  ('done' if succeeded else 'failed', time.time(), job.id))
+
+    def requeue(self, slot: int) -> None:
+        self.__connection.execute("UPDATE jobs SET status = 'queued', slot = NULL WHERE status = 'running' AND slot = ?", (slot,))
+
+    def statuses(self, job_ids: Collection[int]) -> dict[int, tuple[str, Optional[int]]]:
+        # The status of each job and the slot it runs in, if it does
+        placeholders = ', '.join('?' * len(job_ids))
+        rows = self.__connection.execute(f'SELECT id, status, slot FROM jobs WHERE id IN ({placeholders})', tuple(job_ids)).fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def _requeue_orphans(queue: JobQueue, lock_dir: str, slot: int) -> None:
+    # Jobs left running in a slot nobody holds were abandoned by an instance that died. The slot is held while they are put back, so that
+    # an instance taking it meanwhile doesn't have its job requeued under it.
+    with open(_slot_path(lock_dir, slot), 'a+b') as file:
+        if _try_lock(file):
+            try:
+                queue.requeue(slot)
+            finally:
+                _unlock(file)
+
+
+def drain(queue: JobQueue, lock_dir: str, slots: int, handler: Callable[[Job], None], wait_for: Collection[int] = ()) -> int:
+    # Waits for a free slot and runs queued jobs in it until the queue is empty, and then until the jobs in `wait_for` that other instances
+    # picked up are finished. Returns the number of jobs that failed here.
+    failed = 0
+    waiting: set[int] = set()
+    with lock_slot(lock_dir, slots) as slot:
+        logging.info('Draining the job queue in slot %d', slot)
+        while True:
+            if (job := queue.claim(slot)) is None:
+                running = {other for status, other in queue.statuses(wait_for).values() if status == 'running' and other is not None and other != slot}
+                if not running:
+                    break
+                if running != waiting:
+                    logging.info('Waiting for jobs running in slots %s', ', '.join(map(str, sorted(running))))
+                    waiting = running
+                for other in running:
+                    _requeue_orphans(queue, lock_dir, other)
+                time.sleep(SLOT_POLL_INTERVAL)
+                continue
+            try:
+                handler(job)
+                queue.finish(job, succeeded=True)
+            except Exception:
+                logging.exception('Job for %s failed', job.input_path)
+                queue.finish(job, succeeded=False)
+                failed += 1
+    return failed
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import dataclasses
+from typing import Any, Optional
+
+from buganime import settings
+
+
+INDEX_NAME = '.buganime.sqlite3'
+FINGERPRINT_CHUNK_SIZE = 1024 ** 2
+
+
+@dataclasses.dataclass
+class IndexEntry:
+    input_path: str
+    streams: Any
+    output_path: str
+    status: str
+
+
+def fingerprint(input_path: str) -> str:
+    # Hashes the size, head and tail of the file, which is enough to tell a touched or copied file from a changed one without reading all of it
+    digest = hashlib.sha256()
+    with open(input_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        digest.update(size.to_bytes(8, 'little'))
+        digest.update(file.read(FINGERPRINT_CHUNK_SIZE))
+        file.seek(max(size - FINGERPRINT_CHUNK_SIZE, 0))
+        digest.update(file.read(FINGERPRINT_CHUNK_SIZE))
+    return digest.hexdigest()
+
+
+class LibraryIndex:
+    # Remembers what was probed and converted per input file, so a sweep over an unchanged library neither runs ffprobe nor transcodes again.
+    # Calls may come from any thread.
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS files (input_path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                                  'fingerprint TEXT NOT NULL, streams TEXT NOT NULL, parsed TEXT NOT NULL, video_info TEXT, output_path TEXT NOT NULL, '
+                                  'status TEXT NOT NULL, updated_at REAL NOT NULL)')
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
+
+    def lookup(self, input_path: str) -> Optional[IndexEntry]:
+        # Returns the entry recorded for this file if the file hasn't changed since
+        input_path = os.path.abspath(input_path)
+        stat = os.stat(input_path)
+        with self.__lock:
+            row = self.__connection.execute('SELECT size, mtime_ns, fingerprint, streams, output_path, status FROM files WHERE input_path = ?',
+                                            (input_path,)).fetchone()
+        if row is None or row[0] != stat.st_size:
+            return None
+        if row[1] != stat.st_mtime_ns:
+            if fingerprint(input_path) != row[2]:
+                return None
+            with self.__lock:
+                self.__connection.execute('UPDATE files SET mtime_ns = ? WHERE input_path = ?', (stat.st_mtime_ns, input_path))
+        return IndexEntry(input_path=input_path, streams=json.loads(row[3]), output_path=row[4], status=row[5])
+
+    def record(self, input_path: str, streams: Any, parsed: Any, output_path: str) -> None:
+        input_path = os.path.abspath(input_path)
+        stat = os.stat(input_path)
+        parsed_json = json.dumps({'type': type(parsed).__name__, **dataclasses.asdict(parsed)})
+        file_fingerprint = fingerprint(input_path)
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO files (input_path, size, mtime_ns, fingerprint, streams, parsed, output_path, status, '
+                                      "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'probed', ?)",
+                                      (input_path, stat.st_size, stat.st_mtime_ns, file_fingerprint, json.dumps(streams), parsed_json, output_path,
+                                       time.time()))
+
+    def finish(self, input_path: str, video_info: settings.VideoInfo, succeeded: bool) -> None:
+        with self.__lock:
+            self.__connection.execute('UPDATE files SET video_info = ?, status = ?, updated_at = ? WHERE input_path = ?',
+                                      (json.dumps(dataclasses.asdict(video_info)), 'done' if succeeded else 'failed', time.time(),
+                                       os.path.abspath(input_path)))
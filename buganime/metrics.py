@@ -0,0 +1,61 @@
+import os
+import time
+import json
+import contextlib
+import collections
+from typing import Any, Iterator
+
+
+class PipelineMetrics:
+    # Accumulates where the stages of one transcode spend their time. Stages run concurrently, so their seconds add up to more than the elapsed time;
+    # a stage whose seconds approach the elapsed time is the bottleneck. Gauges keep their last and highest values.
+    def __init__(self, labels: dict[str, str]) -> None:
+        self.labels = labels
+        self.__start = time.monotonic()
+        self.stage_seconds: collections.defaultdict[str, float] = collections.defaultdict(float)
+        self.counters: collections.defaultdict[str, int] = collections.defaultdict(int)
+        self.gauges: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage] += time.monotonic() - start
+
+    def count(self, counter: str, value: int = 1) -> None:
+        self.counters[counter] += value
+
+    def gauge(self, gauge: str, value: float) -> None:
+        self.gauges[gauge] = value
+        self.gauges[f'{gauge}_max'] = max(value, self.gauges.get(f'{gauge}_max', value))
+
+    def snapshot(self) -> dict[str, Any]:
+        elapsed = time.monotonic() - self.__start
+        return {**self.labels, 'elapsed_seconds': elapsed, 'fps': self.counters['frames_written'] / max(elapsed, 1e-9),
+                'stage_seconds': dict(self.stage_seconds), 'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def prometheus(self) -> str:
+        # In the text exposition format, e.g. for node_exporter's textfile collector
+        def _labels(**extra: str) -> str:
+            escaped = {key: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in {**self.labels, **extra}.items()}
+            return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+
+        lines = ['# TYPE buganime_stage_seconds_total counter']
+        lines += [f'buganime_stage_seconds_total{_labels(stage=stage)} {seconds}' for stage, seconds in sorted(self.stage_seconds.items())]
+        for counter, count in sorted(self.counters.items()):
+            lines += [f'# TYPE buganime_{counter}_total counter', f'buganime_{counter}_total{_labels()} {count}']
+        for gauge, value in sorted(self.gauges.items()):
+            lines += [f'# TYPE buganime_{gauge} gauge', f'buganime_{gauge}{_labels()} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        # Replaced atomically, so a collector never reads a half-written file
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+            file.write(self.prometheus())
+        os.replace(f'{path}.tmp', path)
+
+    def write_summary(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file, indent=4)
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import urllib.parse
+from typing import Optional
+
+import requests
+
+from buganime.settings import DEFAULT_MODEL, MODELS, ModelSpec
+
+
+MODEL_DIR = os.getenv('BUGANIME_MODEL_DIR', os.path.join(os.getenv('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'buganime'))
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+DOWNLOAD_TIMEOUT = 600
+
+
+def resolve_model(model: str = DEFAULT_MODEL) -> ModelSpec:
+    if model in MODELS:
+        return MODELS[model]
+    if model.endswith('.json'):
+        with open(model, 'r', encoding='utf-8') as file:
+            spec = ModelSpec(**json.load(file))
+        if '://' in spec.source:
+            return spec
+        # A local source is relative to the JSON file, so a model can be shipped as a directory
+        return ModelSpec(**{**spec.__dict__, 'source': os.path.join(os.path.dirname(os.path.abspath(model)), spec.source)})
+    if os.path.isfile(model):
+        return ModelSpec(source=os.path.abspath(model))
+    raise ValueError(f'Unknown model {model}, expected one of {", ".join(MODELS)}, a weights file or a JSON model description')
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _expected_sha256(spec: ModelSpec, path: str) -> Optional[str]:
+    # A pinned SHA-256, or else the one recorded when the weights were first downloaded
+    if spec.sha256 is not None:
+        return spec.sha256.lower()
+    try:
+        with open(f'{path}.sha256', 'r', encoding='utf-8') as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _download(spec: ModelSpec, path: str) -> None:
+    # Streamed into a temporary file next to `path` and moved into place only once complete and verified, so an interrupted download is never
+    # mistaken for the weights, and concurrent downloads don't see each other's partial files
+    logging.info('Downloading %s to %s', spec.source, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.sha256()
+    with requests.get(spec.source, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=f'{os.path.basename(path)}.', suffix='.part', delete=False) as file:
+            try:
+                size = 0
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                file.close()
+                if 'Content-Length' in response.headers and size != int(response.headers['Content-Length']):
+                    raise RuntimeError(f'Download of {spec.source} ended after {size} of {response.headers["Content-Length"]} bytes')
+                if spec.sha256 is not None and digest.hexdigest() != spec.sha256.lower():
+                    raise RuntimeError(f'Download of {spec.source} has SHA-256 {digest.hexdigest()}, expected {spec.sha256}')
+                os.replace(file.name, path)
+            except BaseException:
+                os.unlink(file.name)
+                raise
+    if spec.sha256 is None:
+        # Trusted on first use: later runs only verify the cache against this download
+        logging.warning('No SHA-256 is pinned for %s, trusting the downloaded weights with SHA-256 %s', spec.source, digest.hexdigest())
+        with open(f'{path}.sha256', 'w', encoding='utf-8') as file:
+            file.write(digest.hexdigest())
+
+
+def fetch_weights(spec: ModelSpec) -> str:
+    # Returns the path of the verified weights, downloading them into MODEL_DIR if they aren't there or don't match their SHA-256
+    if '://' not in spec.source:
+        if spec.sha256 is not None and _sha256(spec.source) != spec.sha256.lower():
+            raise RuntimeError(f'{spec.source} does not match its SHA-256 {spec.sha256}')
+        return spec.source
+    path = os.path.join(MODEL_DIR, os.path.basename(urllib.parse.urlparse(spec.source).path))
+    if os.path.isfile(path):
+        expected = _expected_sha256(spec, path)
+        if expected is not None and _sha256(path) == expected:
+            return path
+        logging.warning('Cached weights %s are unverified or corrupt, downloading them again', path)
+    _download(spec, path)
+    return path
@@ -0,0 +1,220 @@
+import os
+import sys
+import abc
+import json
+import shutil
+import asyncio
+import logging
+import fractions
+import contextlib
+import tempfile
+import dataclasses
+from typing import Any, Optional
+
+import numpy
+import torch
+
+from buganime import settings, transcode
+
+
+@dataclasses.dataclass
+class SegmentJob:
+    input_path: str
+    output_path: str
+    height_out: int
+    width_out: int
+    video_info: settings.VideoInfo
+    options: settings.TranscodeOptions
+    start: int
+    count: Optional[int]
+    # Shared by the segments of a video, see transcode.Transcoder
+    crop: Optional[transcode.Crop] = None
+    subtitles_dir: Optional[str] = None
+    calibration_path: Optional[str] = None
+
+
+def _create_transcoder(job: SegmentJob, engine: Optional[transcode.UpscaleEngine] = None,
+                       pool: Optional[transcode.WorkerPool] = None) -> transcode.Transcoder:
+    calibration = numpy.load(job.calibration_path) if job.calibration_path is not None else None
+    return transcode.Transcoder(input_path=job.input_path, output_path=job.output_path, height_out=job.height_out, width_out=job.width_out,
+                                video_info=job.video_info, options=job.options, engine=engine, crop=job.crop, subtitles_dir=job.subtitles_dir,
+                                calibration=calibration, pool=pool)
+
+
+class SegmentExecutor(abc.ABC):
+    # Encodes the frames of `job` into `job.output_path` and returns the number of frames written
+    @abc.abstractmethod
+    async def run(self, job: SegmentJob) -> int:
+        raise NotImplementedError
+
+
+class InProcessExecutor(SegmentExecutor):
+    def __init__(self, engine: Optional[transcode.UpscaleEngine] = None, pool: Optional[transcode.WorkerPool] = None) -> None:
+        self.__lock = asyncio.Lock()
+        self.__engine = engine
+        self.__pool = pool
+
+    async def run(self, job: SegmentJob) -> int:
+        async with self.__lock:
+            return await _create_transcoder(job, self.__engine, self.__pool).run_range(job.output_path, job.start, job.count)
+
+
+class SubprocessExecutor(SegmentExecutor):
+    def __init__(self, workers: int) -> None:
+        self.__semaphore = asyncio.Semaphore(workers)
+
+    async def run(self, job: SegmentJob) -> int:
+        async with self.__semaphore:
+            # buganime may be importable only through the parent's sys.path (e.g. when started from launch.py)
+            package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, (package_root, os.environ.get('PYTHONPATH'))))}
+            proc = await asyncio.subprocess.create_subprocess_exec(sys.executable, '-m', 'buganime.segments', json.dumps(dataclasses.asdict(job)),
+                                                                   stdout=asyncio.subprocess.PIPE, env=env)
+            try:
+                stdout, _ = await proc.communicate()
+            except asyncio.CancelledError:
+                # Cancelling communicate() leaves the worker running, which would keep writing into the work directory behind a rerun's back
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
+                await proc.wait()
+                raise
+            if proc.returncode:
+                raise RuntimeError(f'Segment worker for {job.output_path} failed with exit code {proc.returncode}')
+            return int(stdout.splitlines()[-1])
+
+
+# Options that only change how fast segments are encoded, so a transcode may be resumed with other values
+_SCHEDULING_OPTIONS = ('batch_size', 'workers', 'worker_threads', 'segment_workers', 'encoder_threads', 'pipeline_memory', 'metrics_dir', 'prometheus_path')
+
+
+async def probe_keyframes(input_path: str) -> list[float]:
+    args = ('-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_path, '-loglevel', 'warning')
+    proc = await asyncio.subprocess.create_subprocess_exec('ffprobe', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(f'ffprobe failed on {input_path}: {stderr!r}')
+    keyframes = []
+    for line in stdout.decode().splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+
+# Splits the video into (first frame, frame count) ranges that start on keyframes and last at least `segment_length` seconds.
+# The last range runs to the end of the video and has no count.
+def plan_segments(keyframes: list[float], fps: str, segment_length: float) -> list[tuple[int, Optional[int]]]:
+    starts = [0]
+    for keyframe in keyframes:
+        start = round((keyframe - keyframes[0]) * fractions.Fraction(fps))
+        if start - starts[-1] >= segment_length * fractions.Fraction(fps):
+            starts.append(start)
+    return [(start, end - start) for start, end in zip(starts, starts[1:])] + [(starts[-1], None)]
+
+
+async def _concat_segments(job: SegmentJob, work_dir: str, segments: list[tuple[str, int]]) -> None:
+    # Matroska leaves the last frame of each segment without a duration, so spell the durations out to keep the timestamps contiguous
+    with open(os.path.join(work_dir, 'segments.txt'), 'w', encoding='utf-8') as file:
+        file.writelines(f"file '{segment}'\nduration {float(frames / fractions.Fraction(job.video_info.fps)):.6f}\n" for segment, frames in segments)
+    args = ('-f', 'concat', '-safe', '0', '-i', os.path.join(work_dir, 'segments.txt'), '-i', job.input_path,
+            '-map', '0:v', '-map', f'1:{job.video_info.audio_index}', '-c:v', 'copy', job.output_path,
+            '-loglevel', 'warning', '-y')
+    proc = await asyncio.subprocess.create_subprocess_exec('ffmpeg', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    logging.info('ffmpeg concat: %s%s', str(stdout), str(stderr))
+    if proc.returncode:
+        raise RuntimeError(f'Concatenating the segments in {work_dir} failed')
+
+
+def _load_manifest(manifest_path: str, job: SegmentJob, plan: list[tuple[int, Optional[int]]]) -> dict[str, Any]:
+    # Completed segments are recorded in the manifest, which is only reused if the input, the plan and the options the segments are encoded with
+    # are unchanged
+    input_stat = os.stat(job.input_path)
+    options = {name: value for name, value in dataclasses.asdict(job.options).items() if name not in _SCHEDULING_OPTIONS}
+    key = {'input': os.path.abspath(job.input_path), 'size': input_stat.st_size, 'mtime': input_stat.st_mtime, 'plan': [list(item) for item in plan],
+           'output_size': [job.width_out, job.height_out], 'options': options}
+    with contextlib.suppress(OSError, ValueError):
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            previous: dict[str, Any] = json.load(file)
+        if all(previous.get(name) == value for name, value in key.items()):
+            return previous
+    return {**key, 'done': {}}
+
+
+def _save_manifest(manifest_path: str, manifest: dict[str, Any]) -> None:
+    with open(f'{manifest_path}.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+async def _run_segments(executor: SegmentExecutor, job: SegmentJob, work_dir: str, plan: list[tuple[int, Optional[int]]], manifest: dict[str, Any]) -> None:
+    async def _run_segment(segment: str, start: int, count: Optional[int]) -> None:
+        manifest['done'][segment] = await executor.run(dataclasses.replace(job, output_path=os.path.join(work_dir, segment), start=start, count=count))
+        _save_manifest(os.path.join(work_dir, 'manifest.json'), manifest)
+
+    async with asyncio.TaskGroup() as group:
+        for i, (start, count) in enumerate(plan):
+            if f'{i:05d}.mkv' not in manifest['done']:
+                group.create_task(_run_segment(f'{i:05d}.mkv', start, count))
+
+
+async def _share_setup(job: SegmentJob, work_dir: str) -> SegmentJob:
+    # What only depends on the video is done once here instead of by every segment
+    upscaling = job.video_info.height != job.height_out
+    crop = await asyncio.to_thread(transcode.detect_crop, job.input_path, job.video_info) if job.options.crop_borders and upscaling else None
+    calibration_path = None
+    if job.options.cpu_precision == 'int8' and upscaling:
+        calibration_path = os.path.join(work_dir, 'calibration.npy')
+        numpy.save(calibration_path, await asyncio.to_thread(transcode.sample_calibration, job.input_path, job.video_info, crop))
+    return dataclasses.replace(job, options=dataclasses.replace(job.options, crop_borders=False), crop=crop, calibration_path=calibration_path)
+
+
+async def transcode_segmented(input_path: str, output_path: str, height_out: int, width_out: int, video_info: settings.VideoInfo,
+                              options: settings.TranscodeOptions, executor: Optional[SegmentExecutor] = None, engine: Optional[transcode.UpscaleEngine] = None,
+                              pool: Optional[transcode.WorkerPool] = None) -> None:
+    # Segments run in worker processes of their own with segment_workers > 1, and otherwise one after another in this one, with `engine` and `pool`
+    # when given
+    assert options.segment_length
+    plan = plan_segments(await probe_keyframes(input_path), video_info.fps, options.segment_length)
+    logging.info('Encoding %s in %d segments', input_path, len(plan))
+
+    job = SegmentJob(input_path=input_path, output_path=output_path, height_out=height_out, width_out=width_out, video_info=video_info, options=options,
+                     start=0, count=None)
+    work_dir = f'{output_path}.parts'
+    manifest = _load_manifest(os.path.join(work_dir, 'manifest.json'), job, plan)
+    if manifest['done']:
+        logging.info('Resuming %s with %d of %d segments done', input_path, len(manifest['done']), len(plan))
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir, exist_ok=True)
+
+    # The manifest is loaded first, so it stays keyed on the options as given
+    job = await _share_setup(job, work_dir)
+    with contextlib.ExitStack() as stack:
+        subtitles_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        await asyncio.to_thread(transcode.extract_subtitles, input_path, video_info, subtitles_dir)
+        if executor is None and options.segment_workers > 1:
+            executor = SubprocessExecutor(options.segment_workers)
+        elif executor is None:
+            # Every segment would start worker processes of its own otherwise
+            if pool is None and options.workers > 1 and not torch.cuda.is_available():
+                pool = stack.enter_context(transcode.WorkerPool(options))
+            executor = InProcessExecutor(engine=engine, pool=pool)
+        job = dataclasses.replace(job, subtitles_dir=subtitles_dir)
+        await _run_segments(executor, job, work_dir, plan, manifest)
+    await _concat_segments(job, work_dir, [(segment, manifest['done'][segment]) for segment in sorted(manifest['done']) if manifest['done'][segment]])
+    shutil.rmtree(work_dir)
+
+
+def main(args: list[str]) -> int:
+    job_fields = json.loads(args[0])
+    job = SegmentJob(**{**job_fields, 'video_info': settings.VideoInfo(**job_fields['video_info']),
+                        'options': settings.TranscodeOptions(**job_fields['options']),
+                        'crop': transcode.Crop(**job_fields['crop']) if job_fields['crop'] is not None else None})
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    print(asyncio.run(_create_transcoder(job).run_range(job.output_path, job.start, job.count)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+# What describes a transcode without running it. Kept apart from buganime.transcode, so probing, planning and queueing files doesn't import
+# torch and friends.
+
+# Default for TranscodeOptions.dedup_threshold: only identical frames are reused, which leaves the output as it would be without reuse. Lossy
+# encodes of a held drawing differ by compression noise, which a threshold around 4 catches, but frames are compared with the last upscaled one,
+# so a slow fade or pan changing less than that per frame is then reused in steps.
+DEDUP_THRESHOLD = 0.0
+# Default budget for the decoded and upscaled frames in flight between the decoder and the encoder, which bounds how deep the pipeline may grow
+PIPELINE_MEMORY = 2 * 1024 ** 3
+# Where the model's 4x output is resized to the output resolution: by cv2 on the CPU, by torch on the model's device, or by ffmpeg's scale filter
+RESIZE_BACKENDS = ('cv2', 'torch', 'ffmpeg')
+# How buganime.transcode.UpscaleEngine may compile the model: by tracing it with torch.jit, or with torch.compile
+COMPILE_MODES = ('jit', 'compile')
+# Precisions the model can run in on the CPU: full fp32, bfloat16 autocast, or int8 static quantization calibrated on frames sampled
+# across each video. Under CUDA the model always runs in fp16. See python -m buganime.bench for their speed and quality on this host.
+CPU_PRECISIONS = ('fp32', 'bf16', 'int8')
+
+# How each encoder is told to use a number of threads
+ENCODER_THREAD_ARGS = {'libx265': ('-x265-params', 'pools={}'), 'libx264': ('-threads', '{}'), 'libsvtav1': ('-svtav1-params', 'lp={}')}
+
+
+@dataclass(frozen=True)
+class EncodeProfile:
+    codec: str
+    pixel_format: str = 'yuv420p'
+    # None leaves the encoder's own default
+    preset: Optional[str] = None
+    crf: Optional[int] = None
+
+    def args(self, preset: Optional[str] = None, crf: Optional[int] = None, threads: Optional[int] = None) -> tuple[str, ...]:
+        # `preset` and `crf` override the profile's own
+        preset, crf = preset or self.preset, self.crf if crf is None else crf
+        args: tuple[str, ...] = ('-vcodec', self.codec, '-pix_fmt', self.pixel_format)
+        if preset is not None:
+            args += ('-preset', preset)
+        if crf is not None:
+            args += ('-crf', str(crf))
+        if threads is not None:
+            name, value = ENCODER_THREAD_ARGS[self.codec]
+            args += (name, value.format(threads))
+        return args
+
+
+# 'x265' is libx265 with its defaults, as buganime always encoded. The others trade size or quality for encoding speed, or add 10-bit output.
+# See python -m buganime.bench --stages encode for their speed and size on this host.
+ENCODE_PROFILES = {
+    'x265': EncodeProfile('libx265'),
+    'x265-fast': EncodeProfile('libx265', preset='fast'),
+    'x265-10bit': EncodeProfile('libx265', pixel_format='yuv420p10le'),
+    'x264': EncodeProfile('libx264', preset='fast', crf=18),
+    'av1': EncodeProfile('libsvtav1', pixel_format='yuv420p10le', preset='8', crf=30),
+}
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    # Where the weights come from: a URL, downloaded once into buganime.models.MODEL_DIR, or a local file
+    source: str
+    # SHA-256 of the weights. None trusts the first complete download, whose digest is then kept next to it and checked from then on.
+    sha256: Optional[str] = None
+    # Shape of buganime.transcode.Transcoder.Module the weights are for
+    num_feat: int = 64
+    num_conv: int = 16
+    upscale: int = 4
+
+
+MODELS = {
+    'realesr-animevideov3': ModelSpec(source='https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth'),
+}
+DEFAULT_MODEL = 'realesr-animevideov3'
+
+
+@dataclass
+class VideoInfo:
+    audio_index: int
+    subtitle_index: Optional[int]
+    width: int
+    height: int
+    fps: str
+    frames: int
+
+
+@dataclass
+class TranscodeOptions:
+    # One of MODELS, a local weights file for the default model shape, or a JSON file holding the fields of a ModelSpec
+    model: str = DEFAULT_MODEL
+    # Number of frames per model call. None picks 1 under CUDA and a size fitting buganime.transcode.CPU_BATCH_MEMORY on CPU.
+    batch_size: Optional[int] = None
+    # Memory budget in bytes for the model's activations. When set, frames are upscaled in overlapping tiles sized to fit it.
+    tile_memory: Optional[int] = None
+    # Frames that differ from the last upscaled frame by at most this, see buganime.transcode.frame_difference, reuse its output. 0 only reuses
+    # identical frames and None disables reuse. Anything above 0 is lossy, see DEDUP_THRESHOLD.
+    dedup_threshold: Optional[float] = DEDUP_THRESHOLD
+    # Number of worker processes running the model when there is no CUDA device. 1 runs it in-process.
+    workers: int = 1
+    # Torch threads per worker process. None splits the CPU cores evenly between the workers.
+    worker_threads: Optional[int] = None
+    # One of RESIZE_BACKENDS
+    resize_backend: str = 'cv2'
+    # When set, encode in keyframe-aligned segments of at least this many seconds under <output>.parts, see buganime.segments
+    segment_length: Optional[float] = None
+    # Number of local worker processes encoding segments in parallel. 1 encodes them in-process one after the other.
+    segment_workers: int = 1
+    # One of COMPILE_MODES, or None to run the model eagerly
+    compile_mode: Optional[str] = None
+    # Run the model on channels-last tensors, which some CPU and tensor-core convolution kernels are faster with
+    channels_last: bool = False
+    # One of CPU_PRECISIONS
+    cpu_precision: str = 'fp32'
+    # One of ENCODE_PROFILES, and overrides for its preset and CRF
+    encode_profile: str = 'x265'
+    encode_preset: Optional[str] = None
+    encode_crf: Optional[int] = None
+    # When set, the encoder runs this many threads and the model gets the remaining cores. Where the platform allows it (not on Windows or macOS),
+    # both are pinned to their cores, the encoder through taskset.
+    encoder_threads: Optional[int] = None
+    # Detect black borders and only upscale the picture inside them, see buganime.transcode.detect_crop
+    crop_borders: bool = False
+    # Memory budget in bytes for frames in flight, see PIPELINE_MEMORY
+    pipeline_memory: int = PIPELINE_MEMORY
+    # Directory to write a JSON summary of each transcode's pipeline metrics to
+    metrics_dir: Optional[str] = None
+    # Prometheus text file the pipeline metrics are written to every buganime.transcode.METRICS_INTERVAL seconds while transcoding
+    prometheus_path: Optional[str] = None
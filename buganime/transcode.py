@@ -1,33 +1,470 @@
+import concurrent.futures
 import contextlib
+import copy
+import fractions
+import io
+import json
+import math
 import os
+import time
+import shutil
 import tempfile
+import uuid
 import asyncio
 import logging
+import multiprocessing
+import subprocess
 import warnings
-import shutil
-from dataclasses import dataclass
-from typing import AsyncIterator, cast, Optional
+from multiprocessing import shared_memory
+from dataclasses import dataclass, replace
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Iterator, TypeVar, cast, Optional
 
 import retry
 import torch
+from torch.ao import quantization
+from torch.ao.quantization import quantize_fx
 import cv2
-import requests
+import numpy
+import numpy.typing
 from tqdm import tqdm
 
+from buganime import metrics, models
+from buganime.settings import COMPILE_MODES, CPU_PRECISIONS, DEFAULT_MODEL, ENCODE_PROFILES, MODELS, RESIZE_BACKENDS, TranscodeOptions, VideoInfo
+
+
+_T = TypeVar('_T')
+# Rough size of the model's live activations per input pixel (three 64-channel fp32 feature maps)
+ACTIVATION_BYTES_PER_PIXEL = 64 * 4 * 3
+CPU_BATCH_MEMORY = 2 * 1024 ** 3
+MAX_CPU_BATCH_SIZE = 8
+FRAME_QUEUE_SIZE = 10
+DEPTH_INTERVAL = 5
+# Fraction of a DEPTH_INTERVAL the model may sit idle with the pipeline full before it is deepened
+MODEL_IDLE_RATIO = 0.05
+METRICS_INTERVAL = 30
+# Scale of the default model
+MODEL_SCALE = MODELS[DEFAULT_MODEL].upscale
+# Default overlap between tiles, covering the receptive field of the default model with room to spare
+TILE_OVERLAP = 32
+MIN_TILE_SIZE = 4 * TILE_OVERLAP
+# Size of the square blocks frame_difference compares frames in
+DEDUP_BLOCK_SIZE = 16
+# Frames sampled across the video to find the black borders to crop, and the highest luma that still counts as black
+CROP_SAMPLES = 10
+CROP_BLACK_LEVEL = 24
+# Borders covering less of the frame than this aren't worth cropping
+MIN_CROP_FRACTION = 0.02
+# Frames sampled across the video to calibrate int8 quantization on, and the size of the tile it observes of each. Observing the model on a whole
+# 1080p frame takes over a minute.
+CALIBRATION_SAMPLES = 8
+CALIBRATION_TILE_SIZE = 256
+
 
-MODEL_URL = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth'
-MODEL_PATH = os.path.join(tempfile.gettempdir(), 'realesr-animevideov3.pth')
-FFMPEG_OUTPUT_ARGS = ('-vcodec', 'libx265', '-pix_fmt', 'yuv420p')
+def split_cores(encoder_threads: int) -> tuple[set[int], set[int]]:
+    # Splits the cores this process may run on into ones for the model and the last `encoder_threads` ones for the encoder, leaving the model at
+    # least one. On a single core both share it.
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    split = max(1, len(cores) - encoder_threads)
+    return set(cores[:split]), set(cores[split:]) or set(cores)
 
 
 @dataclass
-class VideoInfo:
-    audio_index: int
-    subtitle_index: Optional[int]
+class Crop:
+    x: int
+    y: int
     width: int
     height: int
-    fps: str
-    frames: int
+
+
+def find_crop(luma: numpy.typing.NDArray[numpy.uint8], black_level: int = CROP_BLACK_LEVEL) -> Optional[Crop]:
+    # Takes the per-pixel maximum luma of the sampled frames, and returns the smallest even-aligned rectangle holding every pixel brighter than
+    # `black_level`, or None if there are no borders worth cropping
+    height, width = luma.shape
+    rows, columns = numpy.flatnonzero(luma.max(axis=1) > black_level), numpy.flatnonzero(luma.max(axis=0) > black_level)
+    if not rows.size:
+        return None
+    top, left = int(rows[0]) // 2 * 2, int(columns[0]) // 2 * 2
+    bottom, right = min(height, (int(rows[-1]) + 2) // 2 * 2), min(width, (int(columns[-1]) + 2) // 2 * 2)
+    if (bottom - top) * (right - left) > (1 - MIN_CROP_FRACTION) * height * width:
+        return None
+    return Crop(x=left, y=top, width=right - left, height=bottom - top)
+
+
+def sample_frames(input_path: str, video_info: VideoInfo, samples: int, gray: bool = False,
+                  crop: Optional[Crop] = None) -> list[numpy.typing.NDArray[numpy.uint8]]:
+    # Decodes `samples` frames spread evenly over the video, or only the first frame if its length is unknown, as HWC RGB frames or HW luma frames if
+    # `gray`, cut to `crop`. Frames that fail to decode are left out.
+    duration = video_info.frames / fractions.Fraction(video_info.fps)
+    positions = [duration * (2 * i + 1) / (2 * samples) for i in range(samples)] if video_info.frames else [fractions.Fraction(0)]
+    width, height = (crop.width, crop.height) if crop is not None else (video_info.width, video_info.height)
+    shape = (height, width) if gray else (height, width, 3)
+    crop_args = ('-vf', f'crop={crop.width}:{crop.height}:{crop.x}:{crop.y}') if crop is not None else ()
+    frames = []
+    for position in positions:
+        args = ('-ss', f'{float(position):.6f}', '-i', input_path, '-frames:v', '1', *crop_args, '-f', 'rawvideo', '-pix_fmt', 'gray' if gray else 'rgb24',
+                'pipe:', '-loglevel', 'warning')
+        proc = subprocess.run(['ffmpeg', *args], capture_output=True, check=True)
+        if len(proc.stdout) == math.prod(shape):
+            frames.append(numpy.frombuffer(proc.stdout, dtype=numpy.uint8).reshape(shape))
+    return frames
+
+
+def detect_crop(input_path: str, video_info: VideoInfo, samples: int = CROP_SAMPLES) -> Optional[Crop]:
+    # Like ffmpeg's cropdetect, but only borders that stay black on all of `samples` frames spread over the video count, so a dark scene doesn't
+    # get cropped
+    if not video_info.frames:
+        logging.info('The length of %s is unknown, not looking for black borders', input_path)
+        return None
+    frames = sample_frames(input_path, video_info, samples, gray=True)
+    return find_crop(numpy.maximum.reduce(frames)) if frames else None
+
+
+def calibration_tiles(frames: list[numpy.typing.NDArray[numpy.uint8]], size: int = CALIBRATION_TILE_SIZE) -> numpy.typing.NDArray[numpy.uint8]:
+    # Cuts a tile of up to `size` pixels out of each HWC frame, moving along the diagonal from one frame to the next, so the tiles of frames sampled
+    # across a video cover its whole picture between them. Returns them as NHWC.
+    height, width = frames[0].shape[:2]
+    tile_height, tile_width = min(size, height), min(size, width)
+    tiles = []
+    for i, frame in enumerate(frames):
+        y, x = ((length - tile) * (2 * i + 1) // (2 * len(frames)) for length, tile in ((height, tile_height), (width, tile_width)))
+        tiles.append(frame[y:y + tile_height, x:x + tile_width])
+    return numpy.stack(tiles)
+
+
+def frame_difference(reference: numpy.typing.NDArray[numpy.uint8], frame: numpy.typing.NDArray[numpy.uint8]) -> float:
+    # The largest mean absolute difference of any channel within a DEDUP_BLOCK_SIZE block of the HWC frames, so a change confined to a small part
+    # of the frame, like a mouth or a caption, isn't averaged away by the rest of it
+    height, width = frame.shape[:2]
+    blocks = cv2.resize(cv2.absdiff(reference, frame), (-(-width // DEDUP_BLOCK_SIZE), -(-height // DEDUP_BLOCK_SIZE)), interpolation=cv2.INTER_AREA)
+    return float(blocks.max())
+
+
+def extract_subtitles(input_path: str, video_info: VideoInfo, directory: str) -> None:
+    # Prepares `directory` for the encoder to run in. For burning subtitles it gets subtitles.mkv: the subtitle stream and attached fonts copied out
+    # of the input, with their original timestamps, so the subtitles filter renders exactly what it would from the input without the input having to
+    # be copied there. The filter gets a relative path, which spares escaping a drive colon on Windows.
+    if video_info.subtitle_index is None:
+        return
+    args = ('-copyts', '-i', input_path, '-map', f'0:s:{video_info.subtitle_index}', '-map', '0:t?', '-c', 'copy', os.path.join(directory, 'subtitles.mkv'),
+            '-loglevel', 'warning', '-y')
+    proc = subprocess.run(['ffmpeg', *args], capture_output=True, text=True, encoding='utf-8', errors='replace', check=False)
+    if proc.returncode:
+        raise RuntimeError(f'Could not extract the subtitles of {input_path}: {proc.stderr}')
+
+
+def sample_calibration(input_path: str, video_info: VideoInfo, crop: Optional[Crop] = None) -> numpy.typing.NDArray[numpy.uint8]:
+    # Returns the tiles of frames sampled across the video that int8 quantization is calibrated on
+    frames = sample_frames(input_path, video_info, CALIBRATION_SAMPLES, crop=crop)
+    if not frames:
+        raise RuntimeError(f'No frames to calibrate on were decoded from {input_path}')
+    return calibration_tiles(frames)
+
+
+def _fit_output(video_info: VideoInfo, width_out: int, height_out: int, crop: Optional[Crop]) -> tuple[int, int, Optional[str]]:
+    # Returns the size the picture is upscaled to, fitting the whole frame in the output. With a crop, also returns the pad filter putting the picture
+    # back in its place within the whole frame.
+    if video_info.width / video_info.height > width_out / height_out:
+        scale = fractions.Fraction(width_out, video_info.width)
+    else:
+        scale = fractions.Fraction(height_out, video_info.height)
+    if crop is None:
+        return round(video_info.width * scale), round(video_info.height * scale), None
+    frame_width, frame_height = round(video_info.width * scale), round(video_info.height * scale)
+    picture_width, picture_height = round(crop.width * scale), round(crop.height * scale)
+    x, y = min(round(crop.x * scale), frame_width - picture_width), min(round(crop.y * scale), frame_height - picture_height)
+    return picture_width, picture_height, f'pad={frame_width}:{frame_height}:{x}:{y}:black'
+
+
+def _to_uint8(frames: torch.Tensor) -> torch.Tensor:
+    # Takes float NCHW frames in [0, 1] on any device and returns uint8 NHWC frames on the CPU
+    return (frames.clamp(0, 1) * 255.0).round().byte().permute(0, 2, 3, 1).cpu()
+
+
+def _tile_spans(length: int, tile_size: int, overlap: int, scale: int) -> list[tuple[slice, slice, slice]]:
+    # Returns the span of each tile in the input, the span kept out of its upscaled tile, and where that goes in the upscaled output
+    step = tile_size - 2 * overlap
+    spans = []
+    for start in range(0, length, step):
+        end, tile_start, tile_end = min(start + step, length), max(0, start - overlap), min(length, start + step + overlap)
+        spans.append((slice(tile_start, tile_end), slice((start - tile_start) * scale, (end - tile_start) * scale), slice(start * scale, end * scale)))
+    return spans
+
+
+def upscale_tiled(model: Callable[[torch.Tensor], torch.Tensor], frames: torch.Tensor, tile_size: int, scale: int = MODEL_SCALE,
+                  overlap: int = TILE_OVERLAP) -> torch.Tensor:
+    # Runs the model on tiles of up to `tile_size` pixels that overlap their neighbors by `overlap` pixels on each side, and keeps only the middle of
+    # each. With an overlap covering the model's receptive field, the zero padding at the tile edges never reaches the kept pixels, so the result
+    # matches upscaling whole frames without blending. Finished tiles go straight into the uint8 NHWC output on the CPU, so besides the output itself
+    # the memory needed only depends on the tile size.
+    if tile_size <= 2 * overlap:
+        raise ValueError(f'Tiles must be larger than {2 * overlap} pixels, got {tile_size}')
+    height, width = frames.shape[2:]
+    output = torch.empty((frames.shape[0], height * scale, width * scale, frames.shape[1]), dtype=torch.uint8)
+    for tile_rows, kept_rows, output_rows in _tile_spans(height, tile_size, overlap, scale):
+        for tile_columns, kept_columns, output_columns in _tile_spans(width, tile_size, overlap, scale):
+            upscaled = model(frames[:, :, tile_rows, tile_columns])
+            output[:, output_rows, output_columns] = _to_uint8(upscaled[:, :, kept_rows, kept_columns])
+    return output
+
+
+def load_model(cuda: bool, model: str = DEFAULT_MODEL) -> torch.nn.Module:
+    spec = models.resolve_model(model)
+    state = torch.load(models.fetch_weights(spec), map_location=None if cuda else torch.device('cpu'))
+    # Real-ESRGAN releases keep the weights under 'params' or 'params_ema', other trainers save the bare state dict
+    state = state.get('params', state.get('params_ema', state))
+    module = Transcoder.Module(num_in_ch=3, num_out_ch=3, num_feat=spec.num_feat, num_conv=spec.num_conv, upscale=spec.upscale)
+    module.load_state_dict(state, strict=True)
+    if cuda:
+        return module.eval().cuda().half()
+    return module.eval()
+
+
+class UpscaleEngine:
+    # A loaded model, ready to upscale batches of frames independently of any video. Loading and compiling are the expensive parts, so long-running
+    # callers create one engine and hand it to every Transcoder.
+    def __init__(self, cuda: Optional[bool] = None, compile_mode: Optional[str] = None, channels_last: bool = False, cpu_precision: str = 'fp32',
+                 model: str = DEFAULT_MODEL) -> None:
+        if compile_mode is not None and compile_mode not in COMPILE_MODES:
+            raise ValueError(f'Unknown compile mode {compile_mode}')
+        if cpu_precision not in CPU_PRECISIONS:
+            raise ValueError(f'Unknown CPU precision {cpu_precision}')
+        spec = models.resolve_model(model)
+        self.scale = spec.upscale
+        # Each of the model's 3x3 convolutions widens its receptive field by a pixel on each side
+        self.__tile_overlap = spec.num_conv + 2
+        self.model = load_model(cuda=torch.cuda.is_available() if cuda is None else cuda, model=model)
+        parameter = next(self.model.parameters())
+        self.device, self.dtype = parameter.device, parameter.dtype
+        self.__precision = cpu_precision if self.device.type == 'cpu' else 'fp16'
+        self.__memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.model = self.model.to(memory_format=self.__memory_format)
+        # None until an int8 engine is calibrated
+        self.__forward: Optional[Callable[[torch.Tensor], torch.Tensor]] = self.model
+        self.__calibrated_on: Optional[tuple[torch.Tensor, Optional[int]]] = None
+        if self.__precision == 'int8':
+            if compile_mode is not None:
+                raise ValueError('int8 precision can not be combined with a compile mode')
+            self.__forward = None
+        elif compile_mode == 'jit':
+            # The model has no data-dependent control flow, so a trace on a tiny frame holds for every frame size. Newer torch versions deprecate
+            # tracing in favor of torch.compile, which needs a C compiler at runtime that tracing doesn't.
+            example = torch.zeros((1, 3, 16, 16), device=self.device, dtype=self.dtype).contiguous(memory_format=self.__memory_format)
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.__forward = torch.jit.trace(self.model, example)  # type: ignore[no-untyped-call]
+        elif compile_mode == 'compile':
+            self.__forward = cast(Callable[[torch.Tensor], torch.Tensor], torch.compile(self.model, dynamic=True))
+
+    @property
+    def precision(self) -> str:
+        return self.__precision
+
+    def calibrate(self, frames: torch.Tensor, tile_size: Optional[int] = None) -> None:
+        # Quantizes an int8 engine to the activation ranges the model reaches on `frames`, uint8 NHWC RGB frames that should represent the whole
+        # video, e.g. ones sampled across it. Calibrating again starts over from the float model, unless it is on the same frames again, like for
+        # each segment of a video. Other precisions need no calibration.
+        if self.__precision != 'int8':
+            return
+        if self.__calibrated_on is not None and self.__calibrated_on[1] == tile_size and torch.equal(self.__calibrated_on[0], frames):
+            return
+        # torch.ao.quantization warns that it is moving to the separate torchao package and about its own default observers, but is still the only
+        # int8 path that ships with torch
+        example = torch.zeros((1, 3, 16, 16)).contiguous(memory_format=self.__memory_format)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            observed = quantize_fx.prepare_fx(copy.deepcopy(self.model), quantization.get_default_qconfig_mapping(), (example,))
+            self.__forward = observed
+            try:
+                for i in range(len(frames)):
+                    self.upscale_batch(frames[i:i + 1], tile_size=tile_size)
+            finally:
+                self.__forward, self.__calibrated_on = None, None
+            self.__forward = quantize_fx.convert_fx(observed)
+        self.__calibrated_on = (frames.clone(), tile_size)
+
+    def warm_up(self, height: int, width: int, batch_size: int = 1, tile_size: Optional[int] = None) -> None:
+        # Runs a dummy batch, so kernel selection and compilation for this frame size happen before the first real frame.
+        # An uncalibrated int8 engine is left alone.
+        if self.__forward is not None:
+            self.upscale_batch(torch.zeros((batch_size, height, width, 3), dtype=torch.uint8), tile_size=tile_size)
+
+    def __run(self, frames: torch.Tensor) -> torch.Tensor:
+        if self.__forward is None:
+            raise RuntimeError('An int8 engine has to be calibrated before it upscales')
+        if self.__precision == 'bf16':
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                return self.__forward(frames).float()
+        return self.__forward(frames)
+
+    def upscale_batch(self, frames: torch.Tensor, tile_size: Optional[int] = None, size: Optional[tuple[int, int]] = None) -> torch.Tensor:
+        # Takes uint8 NHWC RGB frames on any device and returns them upscaled `scale` times, or resized to `size` (height, width), on the CPU
+        with torch.no_grad():
+            frames_float = frames.to(self.device).permute(0, 3, 1, 2).to(self.dtype).contiguous(memory_format=self.__memory_format) / 255
+            if tile_size is None:
+                frames_upscaled_float = self.__run(frames_float).data
+            else:
+                frames_upscaled = upscale_tiled(self.__run, frames_float, tile_size, self.scale, self.__tile_overlap)
+                if size is None:
+                    return frames_upscaled
+                # Resizing needs the whole upscaled frames on the model's device after all
+                frames_upscaled_float = frames_upscaled.to(self.device).permute(0, 3, 1, 2).to(self.dtype) / 255
+            if size is not None:
+                frames_upscaled_float = torch.nn.functional.interpolate(frames_upscaled_float, size=size, mode='bicubic', antialias=True)
+            return _to_uint8(frames_upscaled_float)
+
+
+_WORKER_STATE: dict[str, Any] = {}
+
+
+def _init_worker(threads: int, compile_mode: Optional[str], channels_last: bool, cpu_precision: str, cores: Optional[set[int]], model: str) -> None:
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    engine = UpscaleEngine(cuda=False, compile_mode=compile_mode, channels_last=channels_last, cpu_precision=cpu_precision, model=model)
+    _WORKER_STATE.update(engine=engine, run=None, memory={})
+
+
+@dataclass
+class _PoolRun:
+    # What the workers need to know about the run a batch belongs to. The int8 calibration tiles are in shared memory, as a quantized model can't
+    # be pickled, so each worker quantizes its own on the same tiles.
+    name: str
+    tile_size: Optional[int]
+    calibration: Optional[str] = None
+    calibration_shape: tuple[int, ...] = ()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    memory: dict[str, shared_memory.SharedMemory] = _WORKER_STATE['memory']
+    if name not in memory:
+        memory[name] = shared_memory.SharedMemory(name=name)
+    return memory[name]
+
+
+def _upscale_shared(run: _PoolRun, input_name: str, output_name: str, count: int, height: int, width: int, size: Optional[tuple[int, int]]) -> None:
+    engine: UpscaleEngine = _WORKER_STATE['engine']
+    if _WORKER_STATE['run'] != run.name:
+        # The shared memory of earlier runs is gone, and calibrating on the same tiles again, like for each segment of a video, does nothing
+        for memory in _WORKER_STATE['memory'].values():
+            memory.close()
+        _WORKER_STATE.update(run=run.name, memory={})
+        if run.calibration is not None:
+            tiles = torch.frombuffer(_attach(run.calibration).buf, dtype=torch.uint8, count=math.prod(run.calibration_shape))
+            engine.calibrate(tiles.reshape(run.calibration_shape), run.tile_size)
+    frames = torch.frombuffer(_attach(input_name).buf, dtype=torch.uint8, count=count * height * width * 3).reshape([count, height, width, 3])
+    height_out, width_out = size or (height * engine.scale, width * engine.scale)
+    output = torch.frombuffer(_attach(output_name).buf, dtype=torch.uint8, count=count * height_out * width_out * 3).reshape(
+        [count, height_out, width_out, 3])
+    output.copy_(engine.upscale_batch(frames, run.tile_size, size))
+
+
+class WorkerPool:
+    # Worker processes running the model on the CPU, each with an engine of its own loaded according to `options`. Starting them is the expensive
+    # part, so long-running callers keep one pool open and hand it to every Transcoder.
+    def __init__(self, options: TranscodeOptions) -> None:
+        model_cores = split_cores(options.encoder_threads)[0] if options.encoder_threads is not None else None
+        cores = len(model_cores) if model_cores is not None else os.cpu_count() or 1
+        self.workers = options.workers
+        self.precision = options.cpu_precision
+        threads = options.worker_threads or max(1, cores // self.workers)
+        logging.info('Upscaling in %d worker processes with %d threads each', self.workers, threads)
+        initargs = (threads, options.compile_mode, options.channels_last, options.cpu_precision, model_cores, options.model)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                               initializer=_init_worker, initargs=initargs)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def __enter__(self) -> 'WorkerPool':
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+
+async def _uninterruptible(future: Awaitable[_T]) -> _T:
+    # Awaits a model call running in another thread or process, which can't be interrupted. Cancelled, it still waits for the call to end before
+    # passing the cancellation on, so no call is left running on a shared engine or writing into a buffer that is reused.
+    task = asyncio.ensure_future(future)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        with contextlib.suppress(Exception):
+            await task
+        raise
+
+
+class FramePool:
+    # Buffers are only allocated once none is free, so a pool sized for the deepest pipeline costs the memory of the depth actually reached
+    def __init__(self, count: int, size: int) -> None:
+        self.__free: asyncio.Queue[bytearray] = asyncio.Queue()
+        self.__references: dict[int, int] = {}
+        self.__size = size
+        self.__unallocated = count
+
+    async def acquire(self) -> bytearray:
+        if self.__free.empty() and self.__unallocated:
+            self.__unallocated -= 1
+            buffer = bytearray(self.__size)
+        else:
+            buffer = await self.__free.get()
+        self.__references[id(buffer)] = 1
+        return buffer
+
+    def retain(self, buffer: bytearray) -> None:
+        self.__references[id(buffer)] += 1
+
+    def release(self, buffer: bytearray) -> None:
+        self.__references[id(buffer)] -= 1
+        if not self.__references[id(buffer)]:
+            del self.__references[id(buffer)]
+            self.__free.put_nowait(buffer)
+
+
+class PipelineWindow:
+    # Bounds the number of batches between the decoder and the encoder. Unlike a queue's maxsize, the bound may change while batches are in flight;
+    # when it shrinks, acquire() blocks until enough batches have left.
+    def __init__(self, depth: int) -> None:
+        self.depth = depth
+        self.in_flight = 0
+        self.__changed = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.__changed:
+            await self.__changed.wait_for(lambda: self.in_flight < self.depth)
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        async with self.__changed:
+            self.in_flight -= 1
+            self.__changed.notify_all()
+
+    async def resize(self, depth: int) -> None:
+        async with self.__changed:
+            self.depth = max(1, depth)
+            self.__changed.notify_all()
+
+
+def _read_into(file: io.FileIO, buffer: bytearray) -> bool:
+    view = memoryview(buffer)
+    while view:
+        count = file.readinto(view)
+        if not count:
+            return False
+        view = view[count:]
+    return True
+
+
+async def _prepend(first: bytearray, rest: AsyncIterator[bytearray]) -> AsyncIterator[bytearray]:
+    yield first
+    async for item in rest:
+        yield item
+
+
+@dataclass
+class _SharedSlot:
+    input: shared_memory.SharedMemory
+    output: shared_memory.SharedMemory
 
 
 class Transcoder:
@@ -46,118 +483,498 @@ class Transcoder:
                 tensor = body(tensor)
             return cast(torch.Tensor, self.__upsampler(tensor) + base)
 
-    def __init__(self, input_path: str, output_path: str, height_out: int, width_out: int, video_info: VideoInfo) -> None:
-        if not os.path.isfile(MODEL_PATH):
-            with open(MODEL_PATH, 'wb') as file:
-                file.write(requests.get(MODEL_URL, timeout=600).content)
+    def __init__(self, input_path: str, output_path: str, height_out: int, width_out: int, video_info: VideoInfo,
+                 options: Optional[TranscodeOptions] = None, engine: Optional[UpscaleEngine] = None, crop: Optional[Crop] = None,
+                 subtitles_dir: Optional[str] = None, calibration: Optional[numpy.typing.NDArray[numpy.uint8]] = None,
+                 pool: Optional[WorkerPool] = None) -> None:
+        # Without an `engine`, one is loaded according to `options`. Otherwise the engine's own compile settings apply. Likewise a worker `pool`
+        # runs the model instead of the in-process engine, and when `options` ask for workers without one, a pool is started for the run.
+        # Segments of one video share what only depends on the video: the `crop` to upscale (options.crop_borders only looks for one when it is None),
+        # the directory subtitles were extracted into with extract_subtitles, and the int8 calibration tiles from sample_calibration.
         self.__input_path, self.__output_path = input_path, output_path
         self.__video_info = video_info
+        self.__options = options or TranscodeOptions()
         self.__height_out = height_out
         self.__width_out = width_out
-        self.__upscale_height_out = self.__height_out
-        self.__upscale_width_out = self.__width_out
-        if self.__video_info.width / self.__video_info.height > self.__width_out / self.__height_out:
-            self.__upscale_height_out = round(self.__video_info.height * self.__width_out / self.__video_info.width)
+        self.__upscaling = video_info.height != height_out
+        self.__crop = crop
+        if self.__crop is None and self.__options.crop_borders and self.__upscaling:
+            self.__crop = detect_crop(input_path, video_info)
+        self.__subtitles_dir = subtitles_dir
+        self.__upscale_width_out, self.__upscale_height_out, self.__crop_filter = _fit_output(video_info, width_out, height_out, self.__crop)
+        if self.__crop is not None:
+            # From here on the frames are the picture inside the borders. Only that is upscaled, and put back in its place with black in the encoder.
+            logging.info('Upscaling only the %dx%d picture at %d,%d inside black borders', self.__crop.width, self.__crop.height, self.__crop.x,
+                         self.__crop.y)
+            self.__video_info = replace(video_info, width=self.__crop.width, height=self.__crop.height)
+        if self.__options.resize_backend not in RESIZE_BACKENDS:
+            raise ValueError(f'Unknown resize backend {self.__options.resize_backend}')
+        if self.__options.encode_profile not in ENCODE_PROFILES:
+            raise ValueError(f'Unknown encode profile {self.__options.encode_profile}')
+        self.__model_cores, self.__encoder_cores = self.__split_cores()
+        self.__engine = engine or UpscaleEngine(compile_mode=self.__options.compile_mode, channels_last=self.__options.channels_last,
+                                                cpu_precision=self.__options.cpu_precision, model=self.__options.model)
+        # Size of the frames handed to the encoder, and the size the model resizes to when it does so itself
+        self.__frame_width, self.__frame_height = self.__upscale_width_out, self.__upscale_height_out
+        self.__model_size: Optional[tuple[int, int]] = None
+        if self.__upscaling:
+            if self.__options.resize_backend == 'ffmpeg':
+                self.__frame_width, self.__frame_height = self.__video_info.width * self.__engine.scale, self.__video_info.height * self.__engine.scale
+            elif self.__options.resize_backend == 'torch':
+                self.__model_size = (self.__upscale_height_out, self.__upscale_width_out)
+        self.__batch_size = self.__options.batch_size or self.__default_batch_size()
+        logging.info('Upscaling in batches of %d frames', self.__batch_size)
+        self.__tile_size: Optional[int] = None
+        if self.__options.tile_memory is not None:
+            self.__tile_size = max(MIN_TILE_SIZE, math.isqrt(self.__options.tile_memory // (ACTIVATION_BYTES_PER_PIXEL * self.__batch_size)))
+            logging.info('Upscaling in tiles of up to %dx%d pixels', self.__tile_size, self.__tile_size)
+        self.__calibration = calibration
+        self.__pool = pool
+        self.__gpu_lock: Optional[asyncio.Lock] = None
+        self.__pool_run: Optional[_PoolRun] = None
+        self.__free_slots: Optional[asyncio.Queue[_SharedSlot]] = None
+        self.__frame_tasks_queue: Optional[asyncio.Queue[Optional[asyncio.Task[list[Optional[bytearray]]]]]] = None
+        self.__window: Optional[PipelineWindow] = None
+        self.__max_depth = 1
+        self.__model_busy = 0
+        self.__model_idle_since = time.monotonic()
+        self.__input_pool: Optional[FramePool] = None
+        self.__output_pool: Optional[FramePool] = None
+        self.metrics = metrics.PipelineMetrics(labels={'input': os.path.basename(input_path)})
+
+    def __split_cores(self) -> tuple[Optional[set[int]], Optional[set[int]]]:
+        # Returns the cores of the model and of the encoder, if they are to keep to cores of their own
+        if self.__options.encoder_threads is None:
+            return None, None
+        model_cores, encoder_cores = split_cores(self.__options.encoder_threads)
+        if hasattr(os, 'sched_setaffinity'):
+            logging.info('Encoding on cores %s, upscaling on cores %s', sorted(encoder_cores), sorted(model_cores))
+            if shutil.which('taskset') is None:
+                logging.warning('taskset is not installed, the encoder runs on any core')
         else:
-            self.__upscale_width_out = round(self.__video_info.width * self.__height_out / self.__video_info.height)
-        model = Transcoder.Module(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4)
+            # e.g. Windows and macOS, where the threads are only split between them
+            logging.warning('Pinning to cores is unavailable on this platform, encoding with %d threads and upscaling with %d threads on any core',
+                            self.__options.encoder_threads, len(model_cores))
+        return model_cores, encoder_cores
+
+    def __default_batch_size(self) -> int:
         if torch.cuda.is_available():
-            model.load_state_dict(torch.load(MODEL_PATH)['params'], strict=True)
-            self.__model = model.eval().cuda().half()
-        else:
-            model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu'))['params'], strict=True)
-            self.__model = model.eval()
-        self.__gpu_lock: Optional[asyncio.Lock] = None
-        self.__frame_tasks_queue: Optional[asyncio.Queue[Optional[asyncio.Task[bytes]]]] = None
+            return 1
+        frame_bytes = self.__video_info.width * self.__video_info.height * ACTIVATION_BYTES_PER_PIXEL
+        return max(1, min(MAX_CPU_BATCH_SIZE, CPU_BATCH_MEMORY // frame_bytes))
 
-    async def __read_input_frames(self) -> AsyncIterator[bytes]:
-        args = ('-i', self.__input_path,
+    async def __read_input_frames(self, start: Optional[int], count: Optional[int]) -> AsyncGenerator[bytearray, None]:
+        assert self.__input_pool
+        seek_args = ('-ss', f'{float(start / fractions.Fraction(self.__video_info.fps)):.6f}') if start else ()
+        count_args = ('-frames:v', str(count)) if count else ()
+        crop_args = ('-vf', f'crop={self.__crop.width}:{self.__crop.height}:{self.__crop.x}:{self.__crop.y}') if self.__crop is not None else ()
+        args = (*seek_args, '-i', self.__input_path, *count_args, *crop_args,
                 '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:',
                 '-loglevel', 'warning')
-        proc = await asyncio.subprocess.create_subprocess_exec('ffmpeg', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        read_fd, write_fd = os.pipe()
+        try:
+            proc = await asyncio.subprocess.create_subprocess_exec('ffmpeg', *args, stdout=write_fd, stderr=asyncio.subprocess.PIPE)
+        finally:
+            os.close(write_fd)
+        assert proc.stderr
+        with open(read_fd, 'rb', buffering=0) as stdout:
+            try:
+                while True:
+                    with self.metrics.timed('input_buffer_wait'):
+                        buffer = await self.__input_pool.acquire()
+                    with self.metrics.timed('decode'):
+                        if not await asyncio.to_thread(_read_into, stdout, buffer):
+                            self.__input_pool.release(buffer)
+                            break
+                    self.metrics.count('bytes_in', len(buffer))
+                    yield buffer
+            finally:
+                # Stopped early, the decoder may be blocked writing to the pipe, where it doesn't act on SIGTERM
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
+                logging.info('ffmpeg input: %s', str(await proc.stderr.read()))
+                await proc.wait()
+
+    @contextlib.contextmanager
+    def __encoder_dir(self) -> Iterator[str]:
+        # The encoder runs in a directory the subtitles were extracted into, or a scratch one
+        with contextlib.nullcontext(self.__subtitles_dir) if self.__subtitles_dir is not None else tempfile.TemporaryDirectory() as encoder_dir:
+            if self.__subtitles_dir is None:
+                extract_subtitles(self.__input_path, self.__video_info, encoder_dir)
+            yield encoder_dir
+
+    async def __write_output_frames(self, frames: AsyncIterator[bytearray], temp_dir: str, output_path: str, start: Optional[int]) -> int:
+        filter_str = f'pad={self.__width_out}:{self.__height_out}:(ow-iw)/2:(oh-ih)/2:black'
+        if self.__video_info.subtitle_index is not None:
+            subtitles_str = 'subtitles=subtitles.mkv'
+            if start is not None:
+                # Segments start at timestamp 0, so shift them to their place in the input while rendering the subtitles
+                subtitles_str = f'setpts=PTS+{float(start / fractions.Fraction(self.__video_info.fps)):.6f}/TB, {subtitles_str}, setpts=PTS-STARTPTS'
+            filter_str = f'{subtitles_str}, {filter_str}'
+        if self.__crop_filter is not None:
+            # Restores the borders before the subtitles are rendered, so they land where they would on the whole frame
+            filter_str = f'{self.__crop_filter}, {filter_str}'
+        if (self.__frame_width, self.__frame_height) != (self.__upscale_width_out, self.__upscale_height_out):
+            filter_str = f'scale={self.__upscale_width_out}:{self.__upscale_height_out}:flags=lanczos, {filter_str}'
+        audio_input_args = ('-i', os.path.abspath(self.__input_path)) if start is None else ()
+        audio_map_args = ('-map', f'1:{self.__video_info.audio_index}') if start is None else ()
+        args = ('-f', 'rawvideo', '-framerate', str(self.__video_info.fps), '-pix_fmt', 'rgb24',
+                '-s', f'{self.__frame_width}x{self.__frame_height}',
+                '-i', 'pipe:', *audio_input_args,
+                '-map', '0', *audio_map_args, '-vf', filter_str,
+                *ENCODE_PROFILES[self.__options.encode_profile].args(self.__options.encode_preset, self.__options.encode_crf,
+                                                                     self.__options.encoder_threads),
+                output_path, '-loglevel', 'warning', '-y')
+        # The encoder's threads inherit the affinity taskset starts it with. Setting it between fork and exec isn't safe while threads run, and
+        # lending it this thread's would also pin whatever the other tasks start meanwhile.
+        program: tuple[str, ...] = ('ffmpeg',)
+        taskset = shutil.which('taskset')
+        if self.__encoder_cores is not None and hasattr(os, 'sched_setaffinity') and taskset is not None:
+            program = (taskset, '--cpu-list', ','.join(map(str, sorted(self.__encoder_cores))), 'ffmpeg')
+        proc = await asyncio.subprocess.create_subprocess_exec(*program, *args, stdin=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                               stdout=asyncio.subprocess.PIPE, cwd=temp_dir)
+        assert proc.stdin
         assert proc.stdout
         assert proc.stderr
+        pbar: 'tqdm[None]' = tqdm(total=self.__video_info.frames, initial=start or 0, unit='frame', desc='transcoding')
+        written = 0
         try:
-            frame_length = self.__video_info.width * self.__video_info.height * 3
-            with contextlib.suppress(asyncio.IncompleteReadError):
-                while True:
-                    yield await proc.stdout.readexactly(frame_length)
+            async for frame in frames:
+                with self.metrics.timed('encode'):
+                    proc.stdin.write(frame)
+                    await proc.stdin.drain()
+                self.metrics.count('bytes_out', len(frame))
+                self.metrics.count('frames_written')
+                pbar.update(1)
+                written += 1
         finally:
-            with contextlib.suppress(ProcessLookupError):
-                proc.terminate()
-            logging.info('ffmpeg input: %s', str(await proc.stderr.read()))
+            proc.stdin.close()
+            logging.info('ffmpeg output: %s%s', str(await proc.stdout.read()), str(await proc.stderr.read()))
             await proc.wait()
+        # e.g. the disk filled up while writing the trailer, after every frame was taken
+        if proc.returncode:
+            raise RuntimeError(f'Encoding {output_path} failed with exit code {proc.returncode}')
+        return written
 
-    async def __write_output_frames(self, frames: AsyncIterator[bytes]) -> None:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            if os.path.splitdrive(self.__input_path)[0] == os.path.splitdrive(temp_dir)[0]:
-                os.link(self.__input_path, os.path.join(temp_dir, 'input.mkv'))
-            else:
-                shutil.copy(self.__input_path, os.path.join(temp_dir, 'input.mkv'))
-            filter_str = f'pad={self.__width_out}:{self.__height_out}:(ow-iw)/2:(oh-ih)/2:black'
-            if self.__video_info.subtitle_index is not None:
-                filter_str = f'subtitles=input.mkv:si={self.__video_info.subtitle_index}, {filter_str}'
-            args = ('-f', 'rawvideo', '-framerate', str(self.__video_info.fps), '-pix_fmt', 'rgb24',
-                    '-s', f'{self.__upscale_width_out}x{self.__upscale_height_out}',
-                    '-i', 'pipe:', '-i', 'input.mkv',
-                    '-map', '0', '-map', f'1:{self.__video_info.audio_index}', '-vf', filter_str,
-                    *FFMPEG_OUTPUT_ARGS, self.__output_path,
-                    '-loglevel', 'warning', '-y')
-            proc = await asyncio.subprocess.create_subprocess_exec('ffmpeg', *args, stdin=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
-                                                                   stdout=asyncio.subprocess.PIPE, cwd=temp_dir)
-            assert proc.stdin
-            assert proc.stdout
-            assert proc.stderr
-            pbar: 'tqdm[None]' = tqdm(total=self.__video_info.frames, unit='frame', desc='transcoding')
+    @contextlib.contextmanager
+    def __running_model(self) -> Iterator[None]:
+        # Besides the model's own time, accounts the time no batch was running through it at all as 'model_idle'
+        if not self.__model_busy:
+            self.metrics.stage_seconds['model_idle'] += time.monotonic() - self.__model_idle_since
+        self.__model_busy += 1
+        try:
+            with self.metrics.timed('model'):
+                yield
+        finally:
+            self.__model_busy -= 1
+            if not self.__model_busy:
+                self.__model_idle_since = time.monotonic()
+
+    def __model_idle_seconds(self) -> float:
+        return self.metrics.stage_seconds['model_idle'] + (0 if self.__model_busy else time.monotonic() - self.__model_idle_since)
+
+    @retry.retry(RuntimeError, tries=10, delay=1)
+    def __gpu_upscale(self, frames: torch.Tensor) -> torch.Tensor:
+        return self.__engine.upscale_batch(frames, self.__tile_size, self.__model_size)
+
+    def __resize_frames(self, frames: torch.Tensor, outputs: list[bytearray]) -> None:
+        for frame, output in zip(frames, outputs):
+            if self.__options.resize_backend != 'cv2':
+                numpy.frombuffer(output, dtype=numpy.uint8).reshape(frame.shape)[:] = frame.numpy()
+                continue
+            cv2.resize(frame.numpy(), (self.__upscale_width_out, self.__upscale_height_out), interpolation=cv2.INTER_LANCZOS4,
+                       dst=numpy.frombuffer(output, dtype=numpy.uint8).reshape([self.__upscale_height_out, self.__upscale_width_out, 3]))
+
+    async def __pool_upscale(self, frames: list[bytearray], outputs: list[bytearray]) -> None:
+        assert self.__free_slots
+        assert self.__input_pool
+        with self.metrics.timed('slot_wait'):
+            slot = await self.__free_slots.get()
+        try:
+            assert slot.input.buf is not None
+            for i, frame in enumerate(frames):
+                slot.input.buf[i * len(frame):(i + 1) * len(frame)] = frame
+                self.__input_pool.release(frame)
+            height, width = self.__video_info.height, self.__video_info.width
+            assert self.__pool is not None
+            assert self.__pool_run is not None
+            with self.__running_model():
+                await _uninterruptible(asyncio.get_running_loop().run_in_executor(self.__pool.executor, _upscale_shared, self.__pool_run, slot.input.name,
+                                                                                  slot.output.name, len(frames), height, width, self.__model_size))
+            height_out, width_out = self.__model_size or (height * self.__engine.scale, width * self.__engine.scale)
+            frames_out = torch.frombuffer(slot.output.buf, dtype=torch.uint8, count=len(frames) * height_out * width_out * 3).reshape(
+                [len(frames), height_out, width_out, 3])
+            with self.metrics.timed('resize'):
+                await asyncio.to_thread(self.__resize_frames, frames_out, outputs)
+        finally:
+            self.__free_slots.put_nowait(slot)
+
+    async def __upscale_frames(self, frames: list[Optional[bytearray]]) -> list[Optional[bytearray]]:
+        unique_frames = [frame for frame in frames if frame is not None]
+        if not self.__upscaling or not unique_frames:
+            return frames
+        assert self.__input_pool
+        assert self.__output_pool
+        with self.metrics.timed('output_buffer_wait'):
+            outputs = [await self.__output_pool.acquire() for _ in unique_frames]
+        if self.__pool_run is not None:
+            await self.__pool_upscale(unique_frames, outputs)
+        else:
+            with torch.no_grad():
+                frames_arr = torch.stack([torch.frombuffer(frame, dtype=torch.uint8) for frame in unique_frames]).reshape(
+                    [len(unique_frames), self.__video_info.height, self.__video_info.width, 3])
+            for frame in unique_frames:
+                self.__input_pool.release(frame)
+            assert self.__gpu_lock
+            with self.metrics.timed('lock_wait'):
+                await self.__gpu_lock.acquire()
             try:
-                async for frame in frames:
-                    proc.stdin.write(frame)
-                    await proc.stdin.drain()
-                    pbar.update(1)
+                with self.__running_model():
+                    frames_cpu = await _uninterruptible(asyncio.to_thread(self.__gpu_upscale, frames_arr))
             finally:
-                proc.stdin.close()
-                logging.info('ffmpeg output: %s%s', str(await proc.stdout.read()), str(await proc.stderr.read()))
-                await proc.wait()
+                self.__gpu_lock.release()
+            with self.metrics.timed('resize'):
+                await asyncio.to_thread(self.__resize_frames, frames_cpu, outputs)
+        upscaled_frames = iter(outputs)
+        return [None if frame is None else next(upscaled_frames) for frame in frames]
 
-    @retry.retry(RuntimeError, tries=10, delay=1)
-    def __gpu_upscale(self, frame: torch.Tensor) -> torch.Tensor:
-        with torch.no_grad():
-            if torch.cuda.is_available():
-                frame_float = frame.cuda().permute(2, 0, 1).half() / 255
-            else:
-                frame_float = frame.permute(2, 0, 1) / 255
-            frame_upscaled_float = self.__model(frame_float.unsqueeze(0)).data.squeeze().clamp_(0, 1)
-            return cast(torch.Tensor, (frame_upscaled_float * 255.0).round().byte().permute(1, 2, 0).cpu())
+    async def __is_duplicate(self, reference: Optional[bytearray], frame: bytearray) -> bool:
+        # Without upscaling, reusing a frame would only replace the source frame and save nothing
+        if reference is None or self.__options.dedup_threshold is None or not self.__upscaling:
+            return False
+        if frame == reference:
+            return True
+        if self.__options.dedup_threshold == 0:
+            return False
+        with self.metrics.timed('dedup'):
+            shape = (self.__video_info.height, self.__video_info.width, 3)
+            difference = await asyncio.to_thread(frame_difference, numpy.frombuffer(reference, dtype=numpy.uint8).reshape(shape),
+                                                 numpy.frombuffer(frame, dtype=numpy.uint8).reshape(shape))
+        return difference <= self.__options.dedup_threshold
 
-    async def __upscale_frame(self, frame: bytes) -> bytes:
-        if self.__video_info.height == self.__height_out:
-            return frame
-        with torch.no_grad():
-            with warnings.catch_warnings(action='ignore'):
-                frame_arr = torch.frombuffer(frame, dtype=torch.uint8).reshape([self.__video_info.height, self.__video_info.width, 3])
-        assert self.__gpu_lock
-        async with self.__gpu_lock:
-            frame_cpu = await asyncio.to_thread(self.__gpu_upscale, frame_arr)
-        return cast(bytes, await asyncio.to_thread(
-            lambda: cv2.resize(frame_cpu.numpy(), (self.__upscale_width_out, self.__upscale_height_out), interpolation=cv2.INTER_LANCZOS4).tobytes()))
-
-    async def __generate_upscaling_tasks(self) -> None:
+    async def __queue_batch(self, frames: list[Optional[bytearray]]) -> None:
         assert self.__frame_tasks_queue
-        async for frame in self.__read_input_frames():
-            await self.__frame_tasks_queue.put(asyncio.create_task(self.__upscale_frame(frame)))
-        await self.__frame_tasks_queue.put(None)
+        assert self.__window
+        # Time spent here is the encoder and model not keeping up with decoding
+        with self.metrics.timed('window_full_wait'):
+            await self.__window.acquire()
+        self.__frame_tasks_queue.put_nowait(asyncio.create_task(self.__upscale_frames(frames)))
+        self.metrics.count('batches')
+        self.metrics.gauge('batches_in_flight', self.__window.in_flight)
 
-    async def __get_output_frames(self) -> AsyncIterator[bytes]:
+    async def __generate_upscaling_tasks(self, start: Optional[int], count: Optional[int]) -> None:
         assert self.__frame_tasks_queue
+        assert self.__input_pool
+        frames: list[Optional[bytearray]] = []
+        unique_count = 0
+        reference: Optional[bytearray] = None
+        try:
+            # Closed right away when decoding is cancelled, so the decoder is stopped and waited for
+            async with contextlib.aclosing(self.__read_input_frames(start, count)) as input_frames:
+                async for frame in input_frames:
+                    self.metrics.count('frames_read')
+                    if await self.__is_duplicate(reference, frame):
+                        self.metrics.count('frames_reused')
+                        self.__input_pool.release(frame)
+                        frames.append(None)
+                    else:
+                        if reference is not None:
+                            self.__input_pool.release(reference)
+                        reference = frame
+                        self.__input_pool.retain(reference)
+                        frames.append(frame)
+                        unique_count += 1
+                    if unique_count == self.__batch_size or len(frames) == self.__batch_size * FRAME_QUEUE_SIZE:
+                        await self.__queue_batch(frames)
+                        frames, unique_count = [], 0
+        finally:
+            if reference is not None:
+                self.__input_pool.release(reference)
+        if frames:
+            await self.__queue_batch(frames)
+        self.__frame_tasks_queue.put_nowait(None)
+
+    async def __get_output_frames(self) -> AsyncIterator[bytearray]:
+        assert self.__frame_tasks_queue
+        assert self.__window
+        assert self.__output_pool
+        last_frame: Optional[bytearray] = None
+        try:
+            while True:
+                frames = await self.__frame_tasks_queue.get()
+                if frames is None:
+                    break
+                await self.__window.release()
+                # Time spent here is the encoder waiting for the model
+                with self.metrics.timed('upscale_wait'):
+                    upscaled = await frames
+                for frame in upscaled:
+                    if frame is not None:
+                        if last_frame is not None:
+                            self.__output_pool.release(last_frame)
+                        last_frame = frame
+                    assert last_frame is not None
+                    yield last_frame
+        finally:
+            if last_frame is not None:
+                self.__output_pool.release(last_frame)
+
+    def __pool_workers(self) -> int:
+        # Number of worker processes the model runs in, 0 when it runs in-process
+        if self.__pool is not None:
+            return self.__pool.workers
+        return self.__options.workers if self.__options.workers > 1 and not torch.cuda.is_available() else 0
+
+    @contextlib.contextmanager
+    def __start_workers(self) -> Iterator[None]:
+        if not self.__pool_workers():
+            if self.__model_cores is not None and not torch.cuda.is_available():
+                # Threads torch already started in this process can't be pinned, so the model is only kept to as many threads as it has cores
+                torch.set_num_threads(len(self.__model_cores))
+            yield
+            return
+        owned = self.__pool is None
+        pool = self.__pool = self.__pool or WorkerPool(self.__options)
+        height, width = self.__video_info.height, self.__video_info.width
+        frame_size = self.__batch_size * width * height * 3
+        # The model's output is resized to the output size in the workers with the torch backend, which may be more than `scale` times the input
+        height_out, width_out = self.__model_size or (0, 0)
+        output_size = self.__batch_size * max(height_out * width_out, height * self.__engine.scale * width * self.__engine.scale) * 3
+        memories: list[shared_memory.SharedMemory] = []
+        self.__free_slots = asyncio.Queue()
+        try:
+            for _ in range(pool.workers * 2):
+                memories += [shared_memory.SharedMemory(create=True, size=frame_size), shared_memory.SharedMemory(create=True, size=output_size)]
+                self.__free_slots.put_nowait(_SharedSlot(input=memories[-2], output=memories[-1]))
+            self.__pool_run = _PoolRun(name=uuid.uuid4().hex, tile_size=self.__tile_size)
+            if self.__calibration is not None and pool.precision == 'int8':
+                memories.append(shared_memory.SharedMemory(create=True, size=self.__calibration.nbytes))
+                assert memories[-1].buf is not None
+                memories[-1].buf[:self.__calibration.nbytes] = self.__calibration.tobytes()
+                self.__pool_run = replace(self.__pool_run, calibration=memories[-1].name, calibration_shape=self.__calibration.shape)
+            yield
+        finally:
+            self.__pool_run = None
+            if owned:
+                pool.close()
+                self.__pool = None
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+
+    async def __report_metrics(self) -> None:
         while True:
-            frame = await self.__frame_tasks_queue.get()
-            if frame is None:
-                break
-            yield await frame
+            await asyncio.sleep(METRICS_INTERVAL)
+            logging.info('Pipeline metrics: %s', json.dumps(self.metrics.snapshot()))
+            if self.__options.prometheus_path is not None:
+                await asyncio.to_thread(self.metrics.write_prometheus, self.__options.prometheus_path)
 
-    async def run(self) -> None:
-        self.__gpu_lock = asyncio.Lock()
-        self.__frame_tasks_queue = asyncio.Queue(maxsize=10)
-        gen_task = asyncio.create_task(self.__generate_upscaling_tasks())
-        await self.__write_output_frames(self.__get_output_frames())
+    async def __adapt_depth(self) -> None:
+        # Deepens the pipeline while the model idles with the window full although the encoder also had to wait for it, i.e. while the encoder or
+        # decoder stall in bursts that more batches in flight would absorb. An encoder that is steadily the slowest stage never waits for the model,
+        # so it doesn't deepen the pipeline for nothing.
+        assert self.__window
+        previous, previous_idle = dict(self.metrics.stage_seconds), self.__model_idle_seconds()
+        while self.__window.depth < self.__max_depth:
+            await asyncio.sleep(DEPTH_INTERVAL)
+            current, idle = dict(self.metrics.stage_seconds), self.__model_idle_seconds()
+            full_wait, upscale_wait = (current.get(stage, 0) - previous.get(stage, 0) for stage in ('window_full_wait', 'upscale_wait'))
+            if idle - previous_idle > DEPTH_INTERVAL * MODEL_IDLE_RATIO and full_wait > 0 and upscale_wait > 0:
+                await self.__window.resize(self.__window.depth + 1)
+                self.metrics.gauge('pipeline_depth', self.__window.depth)
+                logging.info('Model idled %.1fs of the last %ds with the pipeline full, deepening it to %d batches', idle - previous_idle, DEPTH_INTERVAL,
+                             self.__window.depth)
+            previous, previous_idle = current, idle
+
+    async def __cancel_batches(self, gen_task: asyncio.Task[None]) -> None:
+        # Stops decoding, and cancels the batches already queued and waits for them, so none is left running on an engine or worker pool the next
+        # video may share
+        assert self.__frame_tasks_queue
+        gen_task.cancel()
+        await asyncio.gather(gen_task, return_exceptions=True)
+        tasks = []
+        while not self.__frame_tasks_queue.empty():
+            if (task := self.__frame_tasks_queue.get_nowait()) is not None:
+                task.cancel()
+                tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __run_pipeline(self, temp_dir: str, output_path: str, start: Optional[int] = None, count: Optional[int] = None) -> int:
+        gen_task = asyncio.create_task(self.__generate_upscaling_tasks(start, count))
+        report_task = asyncio.create_task(self.__report_metrics())
+        adapt_task = asyncio.create_task(self.__adapt_depth())
+        try:
+            frames = self.__get_output_frames()
+            first_frame = await anext(frames, None)
+            written = 0 if first_frame is None else await self.__write_output_frames(_prepend(first_frame, frames), temp_dir, output_path, start)
+        except BaseException:
+            await self.__cancel_batches(gen_task)
+            raise
+        finally:
+            report_task.cancel()
+            adapt_task.cancel()
         await gen_task
+        return written
+
+    def __write_metrics(self, output_path: str) -> None:
+        logging.info('Pipeline metrics: %s', json.dumps(self.metrics.snapshot()))
+        if self.__options.prometheus_path is not None:
+            self.metrics.write_prometheus(self.__options.prometheus_path)
+        if self.__options.metrics_dir is not None:
+            name = os.path.splitext(os.path.basename(output_path))[0]
+            self.metrics.write_summary(os.path.join(self.__options.metrics_dir, f'buganime_{name}_{time.strftime("%Y_%m_%d-%H_%M_%S")}.metrics.json'))
+
+    async def __calibrate(self) -> None:
+        # An int8 model is quantized to the activation ranges of frames sampled across the whole video before the first batch, as the first frames
+        # alone, e.g. a black intro, may not represent it at all. In-process the engine is quantized here, worker processes each quantize their own.
+        in_process = not self.__pool_workers()
+        precision = self.__engine.precision if in_process else self.__pool.precision if self.__pool is not None else self.__options.cpu_precision
+        if not self.__upscaling or precision != 'int8':
+            return
+        if self.__calibration is None:
+            self.__calibration = await asyncio.to_thread(sample_calibration, self.__input_path, self.__video_info, self.__crop)
+        logging.info('Calibrating int8 quantization on %d frames', len(self.__calibration))
+        if in_process:
+            await asyncio.to_thread(self.__engine.calibrate, torch.from_numpy(self.__calibration), self.__tile_size)
+
+    @contextlib.contextmanager
+    def __prepare(self) -> Iterator[str]:
+        self.__gpu_lock = asyncio.Lock()
+        self.__frame_tasks_queue = asyncio.Queue()
+        input_size, output_size = self.__video_info.width * self.__video_info.height * 3, self.__frame_width * self.__frame_height * 3
+        frame_bytes = input_size + output_size if self.__upscaling else input_size
+        # Every batch in the window, plus the ones held by the producer and consumer, may own a buffer per frame
+        self.__max_depth = max(1, (self.__options.pipeline_memory // frame_bytes - 2) // self.__batch_size - 3)
+        # Enough batches to keep every model slot busy, starting from the depth that suited GPUs before the window adapted at runtime
+        model_slots = 2 * self.__pool_workers() or 1
+        self.__window = PipelineWindow(depth=min(self.__max_depth, max(FRAME_QUEUE_SIZE // self.__batch_size, model_slots + 1)))
+        self.metrics.gauge('pipeline_depth', self.__window.depth)
+        logging.info('Pipeline depth %d batches, up to %d within %d MiB of frames', self.__window.depth, self.__max_depth,
+                     self.__options.pipeline_memory // 1024 ** 2)
+        in_flight = (self.__max_depth + 3) * self.__batch_size + 2
+        self.__input_pool = FramePool(count=in_flight, size=input_size)
+        if not self.__upscaling:
+            self.__output_pool = self.__input_pool
+        else:
+            self.__output_pool = FramePool(count=in_flight, size=output_size)
+        self.__model_busy, self.__model_idle_since = 0, time.monotonic()
+        with self.__start_workers(), self.__encoder_dir() as temp_dir:
+            yield temp_dir
+        frames_read, frames_reused = self.metrics.counters['frames_read'], self.metrics.counters['frames_reused']
+        logging.info('Reused the previous upscaled frame for %d of %d frames (%.1f%%)', frames_reused, frames_read, 100 * frames_reused / max(1, frames_read))
+
+    async def run(self) -> None:
+        await self.__calibrate()
+        with self.__prepare() as temp_dir:
+            written = await self.__run_pipeline(temp_dir, self.__output_path)
+        self.__write_metrics(self.__output_path)
+        if not written:
+            raise RuntimeError(f'No frames were decoded from {self.__input_path}')
+
+    async def run_range(self, output_path: str, start: int, count: Optional[int]) -> int:
+        # Encodes `count` frames (or up to the end) from frame `start` as a video-only segment, returning the number of frames written
+        await self.__calibrate()
+        with self.__prepare() as temp_dir:
+            written = await self.__run_pipeline(temp_dir, output_path, start, count)
+        self.__write_metrics(output_path)
+        return written
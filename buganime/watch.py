@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import ctypes
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+
+
+SETTLE_TIME = 60
+POLL_INTERVAL = 300
+
+# From <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+
+
+class _Inotify:
+    # Only used to wake the watcher up early, the events themselves are discarded and the trees rescanned
+    def __init__(self) -> None:
+        self.__libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.__watched: set[str] = set()
+
+    def add(self, directory: str) -> None:
+        if directory in self.__watched:
+            return
+        if self.__libc.inotify_add_watch(self.fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE) < 0:
+            logging.warning('Could not watch %s (%s), relying on polling', directory, os.strerror(ctypes.get_errno()))
+        self.__watched.add(directory)
+
+    def discard_events(self) -> None:
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def _open_inotify() -> Optional[_Inotify]:
+    if sys.platform != 'linux':
+        return None
+    try:
+        return _Inotify()
+    except (OSError, AttributeError):
+        logging.warning('inotify is unavailable, polling for new files every %d seconds', POLL_INTERVAL)
+        return None
+
+
+def _scan(input_paths: list[str], inotify: Optional[_Inotify]) -> dict[str, tuple[int, int]]:
+    files = {}
+    for input_path in input_paths:
+        for root, _, names in os.walk(input_path):
+            if inotify is not None:
+                inotify.add(root)
+            for name in names:
+                path = os.path.join(root, name)
+                if not name.endswith('.mkv'):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+async def _wait(inotify: Optional[_Inotify], timeout: float) -> None:
+    if inotify is None:
+        await asyncio.sleep(timeout)
+        return
+    event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_reader(inotify.fd, event.set)
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(inotify.fd)
+    inotify.discard_events()
+
+
+async def watch_files(input_paths: list[str], settle_time: float = SETTLE_TIME, poll_interval: float = POLL_INTERVAL) -> AsyncIterator[str]:
+    # Yields the .mkv files under `input_paths`, including the ones already there, once they stopped changing for `settle_time` seconds, so files
+    # that are still being downloaded are left alone. A file is yielded again only if it changes afterwards. The trees are rescanned on inotify events
+    # where available, and every `poll_interval` seconds regardless, since inotify doesn't see changes made through network shares.
+    inotify = await asyncio.to_thread(_open_inotify)
+    pending: dict[str, tuple[tuple[int, int], float]] = {}
+    yielded: dict[str, tuple[int, int]] = {}
+    try:
+        while True:
+            files = await asyncio.to_thread(_scan, input_paths, inotify)
+            now = time.monotonic()
+            pending = {path: pending[path] if path in pending and pending[path][0] == key else (key, now)
+                       for path, key in files.items() if yielded.get(path) != key}
+            for path, (key, since) in sorted(pending.items()):
+                if now - since >= settle_time:
+                    del pending[path]
+                    yielded[path] = key
+                    yield path
+            await _wait(inotify, max(0.0, min([since + settle_time - time.monotonic() for _, since in pending.values()] + [poll_interval])))
+    finally:
+        if inotify is not None:
+            inotify.close()
@@ -1,14 +1,21 @@
+import asyncio
 import os
 import tempfile
 import json
 import subprocess
 import functools
+import hashlib
+import dataclasses
 import typing
+import logging
+import shutil
 
 import cv2
+import numpy
 import pytest
+import torch
 
-from buganime import buganime, transcode
+from buganime import bench, buganime, jobs, library, metrics, models, segments, settings, transcode, watch
 
 NAME_CONVERSIONS = [
     (r'C:\[SHiN-gx] Fight Ippatsu! Juuden-chan!! - Special 1 [720x480 AR h.264 FLAC][v2][FF09021F].mkv',
@@ -96,25 +103,619 @@ def test_parse_filename(path: str, result: buganime.TVShow | buganime.Movie) ->
 
 
 STREAM_CONVERSIONS = [
-    ('0.json', transcode.VideoInfo(audio_index=1, subtitle_index=1, width=1920, height=1080, fps='24000/1001', frames=34094)),
-    ('1.json', transcode.VideoInfo(audio_index=1, subtitle_index=3, width=1920, height=1080, fps='24000/1001', frames=34095)),
-    ('2.json', transcode.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='24000/1001', frames=34046)),
-    ('3.json', transcode.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='24000/1001', frames=34045)),
-    ('4.json', transcode.VideoInfo(audio_index=2, subtitle_index=1, width=1920, height=1080, fps='24000/1001', frames=34047)),
-    ('5.json', transcode.VideoInfo(audio_index=2, subtitle_index=1, width=1920, height=1080, fps='24000/1001', frames=35638)),
-    ('6.json', transcode.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='30/1', frames=7425)),
-    ('7.json', transcode.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='24000/1001', frames=0)),
-    ('8.json', transcode.VideoInfo(audio_index=2, subtitle_index=3, width=1920, height=1080, fps='24000/1001', frames=36240)),
-    ('9.json', transcode.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='30000/1001', frames=7194)),
+    ('0.json', settings.VideoInfo(audio_index=1, subtitle_index=1, width=1920, height=1080, fps='24000/1001', frames=34094)),
+    ('1.json', settings.VideoInfo(audio_index=1, subtitle_index=3, width=1920, height=1080, fps='24000/1001', frames=34095)),
+    ('2.json', settings.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='24000/1001', frames=34046)),
+    ('3.json', settings.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='24000/1001', frames=34045)),
+    ('4.json', settings.VideoInfo(audio_index=2, subtitle_index=1, width=1920, height=1080, fps='24000/1001', frames=34047)),
+    ('5.json', settings.VideoInfo(audio_index=2, subtitle_index=1, width=1920, height=1080, fps='24000/1001', frames=35638)),
+    ('6.json', settings.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='30/1', frames=7425)),
+    ('7.json', settings.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='24000/1001', frames=0)),
+    ('8.json', settings.VideoInfo(audio_index=2, subtitle_index=3, width=1920, height=1080, fps='24000/1001', frames=36240)),
+    ('9.json', settings.VideoInfo(audio_index=1, subtitle_index=0, width=1920, height=1080, fps='30000/1001', frames=7194)),
 ]
 
 
 @pytest.mark.parametrize('filename,result', STREAM_CONVERSIONS)
-def test_parse_streams(filename: str, result: transcode.VideoInfo) -> None:
+def test_parse_streams(filename: str, result: settings.VideoInfo) -> None:
     with open(os.path.join(os.path.dirname(__file__), 'data', filename), 'rb') as file:
         assert buganime.parse_streams(json.loads(file.read())['streams']) == result
 
 
+@pytest.mark.parametrize('tile_size', [64, 128, 300])
+def test_upscale_tiled(tile_size: int) -> None:
+    torch.manual_seed(0)
+    model = transcode.Transcoder.Module().eval()
+    y, x = torch.meshgrid(torch.linspace(0, 1, 150), torch.linspace(0, 1, 200), indexing='ij')
+    frames = torch.stack([x, y, (x + y) / 2]).unsqueeze(0)
+    with torch.no_grad():
+        expected = (model(frames).clamp(0, 1) * 255).round().byte().permute(0, 2, 3, 1)
+        # An overlap covering the receptive field of the model's 18 convolutions
+        tiled = transcode.upscale_tiled(model, frames, tile_size, overlap=18)
+    assert tiled.shape == expected.shape
+    assert (tiled.int() - expected.int()).abs().max() <= 1
+
+
+@pytest.mark.parametrize('compile_mode,channels_last', [('jit', False), (None, True)])
+def test_upscale_engine(compile_mode: typing.Optional[str], channels_last: bool) -> None:
+    torch.manual_seed(0)
+    frames = torch.randint(0, 256, (2, 24, 40, 3), dtype=torch.uint8)
+    expected = transcode.UpscaleEngine(cuda=False).upscale_batch(frames)
+    engine = transcode.UpscaleEngine(cuda=False, compile_mode=compile_mode, channels_last=channels_last)
+    engine.warm_up(height=16, width=16)
+    upscaled = engine.upscale_batch(frames)
+    assert upscaled.shape == (2, 24 * transcode.MODEL_SCALE, 40 * transcode.MODEL_SCALE, 3)
+    assert (upscaled.int() - expected.int()).abs().max() <= 1
+
+
+@pytest.mark.parametrize('precision', ['bf16', 'int8'])
+def test_cpu_precision(precision: str) -> None:
+    clip = bench.read_clip(os.path.join(os.path.dirname(__file__), 'data', '0.mkv'), frames=1)
+    frames, calibration = clip[:, 500:580, 900:1000].contiguous(), clip[:, 200:280, 300:400].contiguous()
+    expected = transcode.UpscaleEngine(cuda=False).upscale_batch(frames)[0].numpy()
+    engine = transcode.UpscaleEngine(cuda=False, cpu_precision=precision)
+    if precision == 'int8':
+        with pytest.raises(RuntimeError):
+            engine.upscale_batch(frames)
+    # Calibrated on other frames than the ones scored, like on frames sampled across a video
+    engine.calibrate(calibration)
+    upscaled = engine.upscale_batch(frames)[0].numpy()
+    assert cv2.PSNR(upscaled, expected) > 30
+    assert bench.ssim(upscaled, expected) > 0.9
+
+
+def test_bench_model() -> None:
+    results = bench.bench_model(width=40, height=24, batch_sizes=[1, 2], tile_sizes=[None, 64], frames=2)
+    assert [(result['batch_size'], result['tile_size']) for result in results] == [(1, None), (1, 64), (2, None), (2, 64)]
+    assert all(result['fps'] > 0 for result in results)
+
+
+def test_model_registry() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        # A lighter model in a directory of its own, described by a JSON file next to its weights
+        torch.save({'params': transcode.Transcoder.Module(num_feat=8, num_conv=2, upscale=2).state_dict()}, os.path.join(tempdir, 'light.pth'))
+        with open(os.path.join(tempdir, 'light.pth'), 'rb') as file:
+            sha256 = hashlib.sha256(file.read()).hexdigest()
+        with open(os.path.join(tempdir, 'light.json'), 'w', encoding='utf-8') as file:
+            json.dump({'source': 'light.pth', 'sha256': sha256, 'num_feat': 8, 'num_conv': 2, 'upscale': 2}, file)
+        engine = transcode.UpscaleEngine(cuda=False, model=os.path.join(tempdir, 'light.json'))
+        assert engine.scale == 2
+        assert engine.upscale_batch(torch.zeros((1, 24, 40, 3), dtype=torch.uint8)).shape == (1, 48, 80, 3)
+
+        with open(os.path.join(tempdir, 'light.pth'), 'ab') as file:
+            file.write(b'corrupt')
+        with pytest.raises(RuntimeError):
+            transcode.UpscaleEngine(cuda=False, model=os.path.join(tempdir, 'light.json'))
+        with pytest.raises(ValueError):
+            models.resolve_model(os.path.join(tempdir, 'missing.pth'))
+
+
+def test_model_download(monkeypatch: pytest.MonkeyPatch) -> None:
+    weights = b'weights'
+
+    class _Response:
+        headers = {'Content-Length': str(len(weights))}
+
+        def __enter__(self) -> '_Response':
+            return self
+
+        def __exit__(self, *_: typing.Any) -> None:
+            pass
+
+        def raise_for_status(self) -> None:
+            pass
+
+        def iter_content(self, _: int) -> typing.Iterator[bytes]:
+            yield weights
+
+    monkeypatch.setattr('buganime.models.requests.get', lambda *_, **__: _Response())
+    with tempfile.TemporaryDirectory() as tempdir:
+        monkeypatch.setattr(models, 'MODEL_DIR', tempdir)
+        path = os.path.join(tempdir, 'weights.pth')
+        # A pinned SHA-256 is all the weights are checked against
+        assert models.fetch_weights(settings.ModelSpec(source='https://example.com/weights.pth', sha256=hashlib.sha256(weights).hexdigest())) == path
+        assert not os.path.exists(f'{path}.sha256')
+        with pytest.raises(RuntimeError):
+            models.fetch_weights(settings.ModelSpec(source='https://example.com/weights.pth', sha256='0' * 64))
+        # Without one, the first download is trusted and recorded next to the weights
+        os.unlink(path)
+        assert models.fetch_weights(settings.ModelSpec(source='https://example.com/weights.pth')) == path
+        with open(f'{path}.sha256', 'r', encoding='utf-8') as file:
+            assert file.read() == hashlib.sha256(weights).hexdigest()
+
+
+def test_encode_profiles() -> None:
+    assert settings.ENCODE_PROFILES['x265'].args() == ('-vcodec', 'libx265', '-pix_fmt', 'yuv420p')
+    assert settings.ENCODE_PROFILES['x264'].args(crf=22, threads=2) == ('-vcodec', 'libx264', '-pix_fmt', 'yuv420p', '-preset', 'fast', '-crf', '22',
+                                                                        '-threads', '2')
+    model_cores, encoder_cores = transcode.split_cores(encoder_threads=1)
+    assert model_cores and encoder_cores and (len(model_cores) == 1 or not model_cores & encoder_cores)
+
+
+def test_find_crop() -> None:
+    luma = numpy.zeros((120, 160), dtype=numpy.uint8)
+    assert transcode.find_crop(luma) is None
+    luma[15:105, 3:157] = 200
+    assert transcode.find_crop(luma) == transcode.Crop(x=2, y=14, width=156, height=92)
+    luma[0, 0] = luma[-1, -1] = 30
+    assert transcode.find_crop(luma) is None
+
+
+def test_frame_difference() -> None:
+    rng = numpy.random.default_rng(0)
+    reference = rng.integers(0, 200, (360, 640, 3), dtype=numpy.uint8)
+    noisy = (reference + rng.integers(0, 3, reference.shape, dtype=numpy.uint8)).astype(numpy.uint8)
+    assert transcode.frame_difference(reference, noisy) <= 2
+    # A small change is caught although it hardly moves the mean over the whole frame
+    changed = reference.copy()
+    changed[16:24, 16:24] += 50
+    assert cv2.absdiff(reference, changed).mean() < 0.1
+    assert transcode.frame_difference(reference, changed) > 4
+
+
+def test_pipeline_metrics() -> None:
+    pipeline_metrics = metrics.PipelineMetrics(labels={'input': 'Show "S01E01".mkv'})
+    with pipeline_metrics.timed('model'):
+        pass
+    pipeline_metrics.count('frames_written', 2)
+    pipeline_metrics.gauge('batches_in_flight', 3)
+    pipeline_metrics.gauge('batches_in_flight', 1)
+    snapshot = pipeline_metrics.snapshot()
+    assert snapshot['counters'] == {'frames_written': 2} and snapshot['gauges'] == {'batches_in_flight': 1, 'batches_in_flight_max': 3}
+    lines = pipeline_metrics.prometheus().splitlines()
+    assert 'buganime_frames_written_total{input="Show \\"S01E01\\".mkv"} 2' in lines
+    assert 'buganime_batches_in_flight_max{input="Show \\"S01E01\\".mkv"} 3' in lines
+
+
+def test_frame_pool() -> None:
+    async def _run() -> None:
+        pool = transcode.FramePool(count=1, size=16)
+        buffer = await pool.acquire()
+        assert len(buffer) == 16
+        pool.retain(buffer)
+        pool.release(buffer)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pool.acquire(), timeout=0.1)
+        pool.release(buffer)
+        assert await pool.acquire() is buffer
+    asyncio.run(_run())
+
+
+def test_pipeline_window() -> None:
+    async def _run() -> None:
+        window = transcode.PipelineWindow(depth=2)
+        await window.acquire()
+        await window.acquire()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(window.acquire(), timeout=0.1)
+        await window.resize(3)
+        await asyncio.wait_for(window.acquire(), timeout=1)
+        await window.resize(1)
+        for _ in range(2):
+            await window.release()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(window.acquire(), timeout=0.1)
+        await window.release()
+        await asyncio.wait_for(window.acquire(), timeout=1)
+        assert window.in_flight == 1
+    asyncio.run(_run())
+
+
+SEGMENT_PLANS = [
+    ([0.0], 10, [(0, None)]),
+    ([0.0, 4.0, 8.0, 12.0, 16.0], 10, [(0, 288), (288, None)]),
+    ([1.0, 3.0, 5.0, 11.0, 12.0], 4, [(0, 96), (96, 144), (240, None)]),
+]
+
+
+@pytest.mark.parametrize('keyframes,segment_length,result', SEGMENT_PLANS)
+def test_plan_segments(keyframes: list[float], segment_length: float, result: list[tuple[int, int | None]]) -> None:
+    assert segments.plan_segments(keyframes, '24/1', segment_length) == result
+
+
+def test_segment_resume(monkeypatch: pytest.MonkeyPatch) -> None:
+    class _Executor(segments.SegmentExecutor):
+        def __init__(self, fail_start: typing.Optional[int] = None) -> None:
+            self.starts: list[int] = []
+            self.__fail_start = fail_start
+
+        async def run(self, job: segments.SegmentJob) -> int:
+            self.starts.append(job.start)
+            if job.start == self.__fail_start:
+                raise RuntimeError('Encoding failed')
+            return 24
+
+    async def _probe_keyframes(_: str) -> list[float]:
+        return [0.0, 1.0, 2.0]
+
+    concatenated: list[list[tuple[str, int]]] = []
+
+    async def _concat_segments(_: segments.SegmentJob, __: str, done: list[tuple[str, int]]) -> None:
+        concatenated.append(done)
+
+    monkeypatch.setattr(segments, 'probe_keyframes', _probe_keyframes)
+    monkeypatch.setattr(segments, '_concat_segments', _concat_segments)
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path, output_path = os.path.join(tempdir, 'input.mkv'), os.path.join(tempdir, 'output.mkv')
+        with open(input_path, 'wb') as file:
+            file.write(b'video')
+        video_info = settings.VideoInfo(audio_index=1, subtitle_index=None, width=96, height=64, fps='24', frames=72)
+
+        def _transcode(executor: _Executor, **options: typing.Any) -> None:
+            asyncio.run(segments.transcode_segmented(input_path, output_path, height_out=360, width_out=640, video_info=video_info,
+                                                     options=settings.TranscodeOptions(segment_length=1, **options), executor=executor))
+
+        with pytest.raises(Exception):
+            _transcode(_Executor(fail_start=48))
+        # Failed segments are not recorded, and changing how fast segments are encoded keeps the others
+        executor = _Executor(fail_start=48)
+        with pytest.raises(Exception):
+            _transcode(executor, workers=2)
+        assert executor.starts == [48]
+        # Changing what they are encoded with starts over
+        executor = _Executor()
+        _transcode(executor, encode_crf=20)
+        assert sorted(executor.starts) == [0, 24, 48]
+        assert concatenated == [[('00000.mkv', 24), ('00001.mkv', 24), ('00002.mkv', 24)]]
+        assert not os.path.exists(f'{output_path}.parts')
+
+
+def test_segment_shared_setup(monkeypatch: pytest.MonkeyPatch) -> None:
+    # The crop and the subtitles are found once for the whole video, not by every segment
+    calls: list[str] = []
+    jobs_run: list[segments.SegmentJob] = []
+
+    class _Executor(segments.SegmentExecutor):
+        async def run(self, job: segments.SegmentJob) -> int:
+            jobs_run.append(job)
+            return 24
+
+    async def _probe_keyframes(_: str) -> list[float]:
+        return [0.0, 1.0, 2.0]
+
+    async def _concat_segments(*_: typing.Any) -> None:
+        pass
+
+    def _detect_crop(*_: typing.Any) -> transcode.Crop:
+        calls.append('crop')
+        return transcode.Crop(x=0, y=8, width=96, height=48)
+
+    def _extract_subtitles(*_: typing.Any) -> None:
+        calls.append('subtitles')
+
+    monkeypatch.setattr(segments, 'probe_keyframes', _probe_keyframes)
+    monkeypatch.setattr(segments, '_concat_segments', _concat_segments)
+    monkeypatch.setattr(transcode, 'detect_crop', _detect_crop)
+    monkeypatch.setattr(transcode, 'extract_subtitles', _extract_subtitles)
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path, output_path = os.path.join(tempdir, 'input.mkv'), os.path.join(tempdir, 'output.mkv')
+        with open(input_path, 'wb') as file:
+            file.write(b'video')
+        video_info = settings.VideoInfo(audio_index=1, subtitle_index=0, width=96, height=64, fps='24', frames=72)
+        asyncio.run(segments.transcode_segmented(input_path, output_path, height_out=360, width_out=640, video_info=video_info,
+                                                 options=settings.TranscodeOptions(segment_length=1, crop_borders=True), executor=_Executor()))
+    assert sorted(calls) == ['crop', 'subtitles']
+    assert len(jobs_run) == 3
+    assert all(job.crop == transcode.Crop(x=0, y=8, width=96, height=48) and not job.options.crop_borders for job in jobs_run)
+    assert len({job.subtitles_dir for job in jobs_run}) == 1
+
+
+def test_crop_borders_round_trip(caplog: pytest.LogCaptureFixture) -> None:
+    # Only the picture inside the black borders is upscaled, and padding it back puts it where upscaling the whole frame does
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'input.mkv')
+        subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc2=size=96x48:rate=24', '-t', '0.5', '-vf', 'pad=96:64:0:8:black', '-pix_fmt', 'yuv420p',
+                        input_path, '-loglevel', 'warning'], check=True)
+        video_info = settings.VideoInfo(audio_index=0, subtitle_index=None, width=96, height=64, fps='24', frames=12)
+        outputs = []
+        for crop_borders in (False, True):
+            output_path = os.path.join(tempdir, f'{crop_borders}.mkv')
+            with caplog.at_level(logging.INFO):
+                transcoder = transcode.Transcoder(input_path=input_path, output_path=output_path, height_out=360, width_out=640, video_info=video_info,
+                                                  options=settings.TranscodeOptions(crop_borders=crop_borders, encode_profile='x264'))
+            assert asyncio.run(transcoder.run_range(output_path, 0, None)) == 12
+            outputs.append(bench.read_clip(output_path, frames=12).numpy())
+    assert 'Upscaling only the 96x48 picture at 0,8' in caplog.text
+    assert outputs[0].shape == outputs[1].shape == (12, 360, 640, 3)
+    assert cv2.PSNR(outputs[0], outputs[1]) > 35
+    # The borders are restored as black, and the picture starts right below them
+    assert outputs[1][:, :40].max() < 20 and outputs[1][:, -40:].max() < 20
+    assert outputs[1][:, 50:-50].mean() > 40
+
+
+@pytest.mark.parametrize('segment_workers', [1, 2])
+def test_segmented_transcode(monkeypatch: pytest.MonkeyPatch, segment_workers: int) -> None:
+    # Segments give what a single pass does, whether run in-process on one pool for the whole video or in workers the job is handed to as JSON
+    pools: list[transcode.WorkerPool] = []
+
+    class _WorkerPool(transcode.WorkerPool):
+        def __init__(self, options: settings.TranscodeOptions) -> None:
+            super().__init__(options)
+            pools.append(self)
+
+    segment_jobs = []
+    create_subprocess_exec = asyncio.subprocess.create_subprocess_exec
+
+    async def spy(*args: typing.Any, **kwargs: typing.Any) -> asyncio.subprocess.Process:
+        if args[1:3] == ('-m', 'buganime.segments'):
+            segment_jobs.append(json.loads(args[3]))
+        return await create_subprocess_exec(*args, **kwargs)
+    monkeypatch.setattr(transcode, 'WorkerPool', _WorkerPool)
+    monkeypatch.setattr(asyncio.subprocess, 'create_subprocess_exec', spy)
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'input.mkv')
+        subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc2=size=96x48:rate=24', '-f', 'lavfi', '-i', 'sine=frequency=440', '-t', '1',
+                        '-vf', 'pad=96:64:0:8:black', '-g', '6', '-pix_fmt', 'yuv420p', input_path, '-loglevel', 'warning'], check=True)
+        video_info = settings.VideoInfo(audio_index=1, subtitle_index=None, width=96, height=64, fps='24', frames=24)
+        options = settings.TranscodeOptions(crop_borders=True, encode_profile='x264')
+        single_path, segmented_path = os.path.join(tempdir, 'single.mkv'), os.path.join(tempdir, 'segmented.mkv')
+        asyncio.run(transcode.Transcoder(input_path=input_path, output_path=single_path, height_out=360, width_out=640, video_info=video_info,
+                                         options=options).run())
+        options = dataclasses.replace(options, segment_length=0.5, segment_workers=segment_workers, workers=3 - segment_workers)
+        asyncio.run(segments.transcode_segmented(input_path, segmented_path, height_out=360, width_out=640, video_info=video_info, options=options))
+        single, segmented = bench.read_clip(single_path, frames=24).numpy(), bench.read_clip(segmented_path, frames=24).numpy()
+    assert len(pools) == (1 if segment_workers == 1 else 0)
+    assert [job['crop'] for job in segment_jobs] == [{'x': 0, 'y': 8, 'width': 96, 'height': 48}] * (0 if segment_workers == 1 else 2)
+    assert single.shape == segmented.shape == (24, 360, 640, 3)
+    assert cv2.PSNR(single, segmented) > 40
+
+
+def test_prepare_files(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def _prepare_file(input_path: str, **_: typing.Any) -> buganime.PreparedFile:
+        # Later files finish probing first, and the broken one fails
+        await asyncio.sleep(0.01 * (5 - int(os.path.basename(input_path)[0])))
+        if input_path.endswith('2.mkv'):
+            raise RuntimeError('No default video stream found')
+        return buganime.PreparedFile(input_path=input_path, output_path='', video_info=settings.VideoInfo(0, None, 1, 1, '1', 1))
+
+    async def _collect(input_path: str) -> list[tuple[str, bool]]:
+        return [(os.path.basename(path), prepared is not None) async for path, prepared in buganime.prepare_files(input_path, prefetch=2)]
+
+    monkeypatch.setattr(buganime, 'prepare_file', _prepare_file)
+    with tempfile.TemporaryDirectory() as tempdir:
+        for name in ('1.mkv', '2.mkv', '3.txt', '4.mkv'):
+            with open(os.path.join(tempdir, name), 'wb'):
+                pass
+        assert sorted(asyncio.run(_collect(tempdir))) == [('1.mkv', True), ('2.mkv', False), ('4.mkv', True)]
+
+
+def test_dry_run(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]) -> None:
+    async def _prepare_file(input_path: str, **_: typing.Any) -> buganime.PreparedFile:
+        if input_path.endswith('2.mkv'):
+            raise RuntimeError('No default video stream found')
+        return buganime.PreparedFile(input_path=input_path, output_path=f'{input_path}.out.mkv', converted=input_path.endswith('3.mkv'),
+                                     video_info=settings.VideoInfo(audio_index=1, subtitle_index=None, width=1920, height=1080, fps='24', frames=48))
+
+    monkeypatch.setattr(buganime, 'prepare_file', _prepare_file)
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_dir, output_dir = os.path.join(tempdir, 'input'), os.path.join(tempdir, 'output')
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+        monkeypatch.setattr(buganime, 'OUTPUT_DIR', output_dir)
+        for name in ('1.mkv', '2.mkv', '3.mkv'):
+            with open(os.path.join(input_dir, name), 'wb'):
+                pass
+        # The file that can't be converted fails the run
+        assert buganime.main(['--dry-run', input_dir]) == 1
+        lines = sorted(capsys.readouterr().out.splitlines())
+        path = os.path.join(input_dir, '1.mkv')
+        assert lines[0] == f'{path} -> {path}.out.mkv: 1920x1080 at 24 fps, 48 frames, audio stream 1, no subtitles'
+        assert lines[1] == f'{os.path.join(input_dir, "2.mkv")}: can not be converted'
+        assert lines[2].startswith(f'{os.path.join(input_dir, "3.mkv")} -> ') and '(already converted)' in lines[2]
+        # Neither converted, queued, indexed nor logged
+        assert sorted(os.listdir(input_dir)) == ['1.mkv', '2.mkv', '3.mkv']
+        assert not os.listdir(output_dir)
+
+
+def test_library_index() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'Show S01E01.mkv')
+        with open(input_path, 'wb') as file:
+            file.write(b'video')
+        index = library.LibraryIndex(os.path.join(tempdir, library.INDEX_NAME))
+        try:
+            assert index.lookup(input_path) is None
+            index.record(input_path, streams=[{'index': 0}], parsed=buganime.TVShow(name='Show', season=1, episode=1), output_path='out.mkv')
+            index.finish(input_path, settings.VideoInfo(0, None, 1, 1, '1', 1), succeeded=True)
+            entry = index.lookup(input_path)
+            assert entry and entry.streams == [{'index': 0}] and entry.status == 'done'
+
+            # Touching the file keeps the entry, changing its contents drops it
+            os.utime(input_path, ns=(0, 0))
+            assert index.lookup(input_path) is not None
+            with open(input_path, 'wb') as file:
+                file.write(b'other')
+            assert index.lookup(input_path) is None
+        finally:
+            index.close()
+
+
+def test_watch_files() -> None:
+    async def _watch(tempdir: str) -> None:
+        files = aiter(watch.watch_files([tempdir], settle_time=0.2, poll_interval=0.05))
+        next_file = asyncio.ensure_future(anext(files))
+        with open(os.path.join(tempdir, 'Show S01E01.mkv'), 'wb') as file:
+            # Still being written, so it must not be picked up yet
+            file.write(b'video')
+            file.flush()
+            await asyncio.sleep(0.1)
+            assert not next_file.done()
+            file.write(b'more')
+        assert os.path.basename(await asyncio.wait_for(next_file, 5)) == 'Show S01E01.mkv'
+        await files.aclose()  # type: ignore[attr-defined]
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        asyncio.run(_watch(tempdir))
+
+
+def test_job_queue() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        queue = jobs.JobQueue(os.path.join(tempdir, 'queue.sqlite3'))
+        try:
+            queue.enqueue('low.mkv', priority=0)
+            queue.enqueue('high.mkv', priority=5, options=settings.TranscodeOptions(batch_size=2))
+            queue.enqueue('low.mkv', priority=1)
+            claimed = [queue.claim(slot=0), queue.claim(slot=1)]
+            assert [os.path.basename(job.input_path) for job in claimed if job] == ['high.mkv', 'low.mkv']
+            assert claimed[0] and claimed[0].options.batch_size == 2
+            queue.finish(claimed[0], succeeded=True)
+            assert queue.claim(slot=0) is None
+
+            # Claiming a slot again puts back whatever a previous owner of that slot left running
+            job = queue.claim(slot=1)
+            assert job and os.path.basename(job.input_path) == 'low.mkv' and job.video_info is None
+            queue.finish(job, succeeded=True)
+            assert queue.claim(slot=1) is None
+
+            # What was found when queueing a file is kept with its job, as long as the file doesn't change
+            input_path = os.path.join(tempdir, 'probed.mkv')
+            with open(input_path, 'wb') as file:
+                file.write(b'video')
+            video_info = settings.VideoInfo(audio_index=1, subtitle_index=None, width=96, height=64, fps='24', frames=24)
+            for changed in (False, True):
+                queue.enqueue(input_path, output_path='out.mkv', video_info=video_info)
+                if changed:
+                    os.utime(input_path, ns=(0, 0))
+                job = queue.claim(slot=0)
+                assert job and (job.output_path, job.video_info) == ((None, None) if changed else (os.path.abspath('out.mkv'), video_info))
+                queue.finish(job, succeeded=True)
+        finally:
+            queue.close()
+
+
+def test_lock_slot() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        with jobs.lock_slot(tempdir, slots=2) as first:
+            with jobs.lock_slot(tempdir, slots=2) as second:
+                assert {first, second} == {0, 1}
+
+
+def test_drain_waits_for_other_slots(monkeypatch: pytest.MonkeyPatch) -> None:
+    # Jobs another instance picked up count for whoever queued them, and the ones it abandoned are run here
+    monkeypatch.setattr(jobs, 'SLOT_POLL_INTERVAL', 0)
+    with tempfile.TemporaryDirectory() as tempdir:
+        queue = jobs.JobQueue(os.path.join(tempdir, 'queue.sqlite3'))
+        try:
+            failed_id, abandoned_id = queue.enqueue('failed.mkv'), queue.enqueue('abandoned.mkv')
+            failed_job, abandoned_job = queue.claim(slot=0), queue.claim(slot=2)
+            assert failed_job and abandoned_job
+            handled = []
+            with jobs.lock_slot(tempdir, slots=1):
+                def handler(job: jobs.Job) -> None:
+                    # Slot 0 is held by the other instance, which finishes its job while this one runs the abandoned one
+                    assert failed_job
+                    queue.finish(failed_job, succeeded=False)
+                    handled.append(os.path.basename(job.input_path))
+                assert jobs.drain(queue, tempdir, slots=2, handler=handler, wait_for=[failed_id, abandoned_id]) == 0
+            assert handled == ['abandoned.mkv']
+            assert queue.statuses([failed_id, abandoned_id]) == {failed_id: ('failed', None), abandoned_id: ('done', None)}
+        finally:
+            queue.close()
+
+
+@pytest.mark.parametrize('resize_backend', ['cv2', 'torch'])
+def test_worker_pool(resize_backend: str) -> None:
+    # Upscaling in worker processes through shared memory gives what upscaling in-process does
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'input.mkv')
+        subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc2=size=96x64:rate=24', '-t', '1', '-pix_fmt', 'yuv420p', input_path, '-loglevel', 'warning'],
+                       check=True)
+        video_info = settings.VideoInfo(audio_index=0, subtitle_index=None, width=96, height=64, fps='24', frames=24)
+        outputs = []
+        for workers in (1, 2):
+            output_path = os.path.join(tempdir, f'{workers}.mkv')
+            options = settings.TranscodeOptions(workers=workers, resize_backend=resize_backend, encode_profile='x264')
+            transcoder = transcode.Transcoder(input_path=input_path, output_path=output_path, height_out=360, width_out=640, video_info=video_info,
+                                              options=options)
+            assert asyncio.run(transcoder.run_range(output_path, 0, None)) == 24
+            outputs.append(bench.read_clip(output_path, frames=24).numpy())
+        assert outputs[0].shape == outputs[1].shape == (24, 360, 640, 3)
+        assert cv2.PSNR(outputs[0], outputs[1]) > 40
+
+
+def test_shared_worker_pool() -> None:
+    # Like in the daemon, one pool upscales video after video, also after one failed
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'input.mkv')
+        subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc2=size=96x64:rate=24', '-t', '2', '-pix_fmt', 'yuv420p', input_path, '-loglevel', 'warning'],
+                       check=True)
+        video_info = settings.VideoInfo(audio_index=0, subtitle_index=None, width=96, height=64, fps='24', frames=48)
+
+        async def _transcode(output_path: str, pool: typing.Optional[transcode.WorkerPool]) -> int:
+            transcoder = transcode.Transcoder(input_path=input_path, output_path=output_path, height_out=360, width_out=640, video_info=video_info,
+                                              options=settings.TranscodeOptions(encode_profile='x264', batch_size=4), pool=pool)
+            try:
+                return await transcoder.run_range(output_path, 0, None)
+            finally:
+                # Nothing is left running once a transcode is over, even a failed one
+                await asyncio.sleep(0)
+                assert asyncio.all_tasks() == {asyncio.current_task()}
+
+        assert asyncio.run(_transcode(os.path.join(tempdir, 'expected.mkv'), None)) == 48
+        with transcode.WorkerPool(settings.TranscodeOptions(workers=2)) as pool:
+            with pytest.raises(Exception):
+                asyncio.run(_transcode(os.path.join(tempdir, 'missing', 'output.mkv'), pool))
+            assert asyncio.run(_transcode(os.path.join(tempdir, 'output.mkv'), pool)) == 48
+        expected, output = (bench.read_clip(os.path.join(tempdir, name), frames=48).numpy() for name in ('expected.mkv', 'output.mkv'))
+        assert cv2.PSNR(expected, output) > 40
+
+
+def test_dedup_fade() -> None:
+    # A fade changing less than a near-duplicate threshold per frame is only reused in steps when reuse is asked for
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'input.mkv')
+        subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'color=white:size=96x64:rate=24:duration=3,fade=in:0:72', '-pix_fmt', 'yuv420p', input_path,
+                        '-loglevel', 'warning'], check=True)
+        video_info = settings.VideoInfo(audio_index=0, subtitle_index=None, width=96, height=64, fps='24', frames=72)
+        outputs, reused = [], []
+        for dedup_threshold in (settings.TranscodeOptions().dedup_threshold, None, 4.0):
+            output_path = os.path.join(tempdir, f'{dedup_threshold}.mkv')
+            options = settings.TranscodeOptions(dedup_threshold=dedup_threshold, encode_profile='x264')
+            transcoder = transcode.Transcoder(input_path=input_path, output_path=output_path, height_out=360, width_out=640, video_info=video_info,
+                                              options=options)
+            assert asyncio.run(transcoder.run_range(output_path, 0, None)) == 72
+            outputs.append(bench.read_clip(output_path, frames=72).numpy())
+            reused.append(transcoder.metrics.counters['frames_reused'])
+        assert reused[0] == 0 and reused[2] > 0
+        assert numpy.array_equal(outputs[0], outputs[1])
+
+
+def test_encoder_threads_without_affinity(monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture) -> None:
+    # Like on Windows, the threads are still split between the encoder and the model, but nothing claims they are pinned
+    monkeypatch.delattr(os, 'sched_setaffinity', raising=False)
+    video_info = settings.VideoInfo(audio_index=0, subtitle_index=None, width=96, height=64, fps='24', frames=24)
+    with caplog.at_level(logging.INFO):
+        transcode.Transcoder(input_path='input.mkv', output_path='output.mkv', height_out=360, width_out=640, video_info=video_info,
+                             options=settings.TranscodeOptions(encoder_threads=1))
+    assert 'unavailable' in caplog.text
+    assert 'on cores' not in caplog.text
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity') or shutil.which('taskset') is None, reason='pinning to cores is unavailable')
+def test_encoder_pinned(monkeypatch: pytest.MonkeyPatch) -> None:
+    # The encoder is started on its cores by taskset, leaving the affinity of this process alone
+    programs = []
+    create_subprocess_exec = asyncio.subprocess.create_subprocess_exec
+
+    async def spy(*args: typing.Any, **kwargs: typing.Any) -> asyncio.subprocess.Process:
+        programs.append(args)
+        return await create_subprocess_exec(*args, **kwargs)
+    monkeypatch.setattr(asyncio.subprocess, 'create_subprocess_exec', spy)
+    affinity = os.sched_getaffinity(0)
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'input.mkv')
+        subprocess.run(['ffmpeg', '-f', 'lavfi', '-i', 'testsrc2=size=96x64:rate=24', '-t', '0.5', '-pix_fmt', 'yuv420p', input_path, '-loglevel', 'warning'],
+                       check=True)
+        video_info = settings.VideoInfo(audio_index=0, subtitle_index=None, width=96, height=64, fps='24', frames=12)
+        output_path = os.path.join(tempdir, 'output.mkv')
+        transcoder = transcode.Transcoder(input_path=input_path, output_path=output_path, height_out=360, width_out=640, video_info=video_info,
+                                          options=settings.TranscodeOptions(encoder_threads=1, encode_profile='x264'))
+        assert asyncio.run(transcoder.run_range(output_path, 0, None)) == 12
+    _, encoder_cores = transcode.split_cores(encoder_threads=1)
+    assert [args[:3] for args in programs if 'taskset' in args[0]] == [(shutil.which('taskset'), '--cpu-list', ','.join(map(str, sorted(encoder_cores))))]
+    assert os.sched_getaffinity(0) == affinity
+
+
 def _check_side_bars(frame: typing.Any, bar_size: int) -> None:
     assert max(cv2.mean(frame[0:, :bar_size])[:3]) < 1
     assert max(cv2.mean(frame[0:, -bar_size:])[:3]) < 1